@@ -23,13 +23,53 @@ Connections (+RTT computations) and datagrams structures
 """
 
 
-import logging, unittest, random
+import logging, unittest, random, copy, signal, time
 from datetime import datetime, timedelta
+from collections import namedtuple
+from contextlib import contextmanager
+from functools import partial
 import colors as C
-try:
-    from texttable import Texttable
-except ImportError:
-    Texttable = None
+
+Texttable = None # imported on demand, see load_texttable
+
+# Fields of the connections which can be required (e.g. by the plugins),
+# so that only these fields are extracted from the capture
+BANNERS = 'banners' # client_protocol, server_protocol
+KEXINIT = 'kexinit' # client_algos, server_algos
+TIMES = 'times' # datagram.time
+SIZES = 'sizes' # datagram.payload_len, datagram.total_len
+SEQ_ACK = 'seq_ack' # datagram.seq_nb, datagram.ack
+RTT = 'rtt' # datagram.rtt (implies TIMES and SEQ_ACK)
+DATAGRAMS_FIELDS = frozenset((TIMES, SIZES, SEQ_ACK, RTT))
+ALL_FIELDS = frozenset((BANNERS, KEXINIT)) | DATAGRAMS_FIELDS
+
+# Ways of sampling the datagrams of a connection (see Connection.sample)
+SAMPLINGS = ('first', 'last', 'uniform')
+
+# Algorithms of a KEXINIT packet: each name-list is a tuple of names
+Kexinit = namedtuple('Kexinit', ('kex_algorithms',
+        'server_host_key_algorithms',
+        'encryption_algorithms_client_to_server',
+        'encryption_algorithms_server_to_client',
+        'mac_algorithms_client_to_server', 'mac_algorithms_server_to_client',
+        'compression_algorithms_client_to_server',
+        'compression_algorithms_server_to_client'))
+
+def load_texttable():
+    """Import Texttable if needed, return False if it is not available"""
+    global Texttable
+    if Texttable is None:
+        try:
+            from texttable import Texttable
+        except ImportError:
+            return False
+    return True
+
+EPOCH = datetime(1970, 1, 1)
+
+def td_us(td):
+    """Number of microseconds of a timedelta instance"""
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
 
 def str_td(td, short=False):
     """Better representation of a timedelta instance"""
@@ -60,16 +100,21 @@ def str_td(td, short=False):
     return s
 
 
-class Connection:
+class Connection(object):
     """A SSH connection"""
 
     def __init__(self, nb, datagrams, start_time, duration,
                  client_ip, server_ip, client_port, server_port,
                  client_protocol, server_protocol,
-                 client_algos, server_algos, is_ssh):
+                 client_algos, server_algos, is_ssh,
+                 datagrams_loader=None, sent_stats=None):
         self.nb = nb
         self.logger = logging.getLogger('Conn%d' % self.nb)
-        self.datagrams = datagrams # list of Datagram instances
+        # list of Datagram instances, or None if they are to be loaded by
+        # datagrams_loader (a callable returning the list) on first use
+        self._datagrams = datagrams
+        self.datagrams_loader = datagrams_loader
+        self.rtt_on_load = False # compute the RTTs when loading datagrams
         self.start_time = start_time # instance of datetime.datetime
         self.duration = duration # instance of datetime.timedelta
         self.client_ip = client_ip # string e.g. '123.234.0.42'
@@ -80,17 +125,117 @@ class Connection:
         # (e.g. 'SSH-2.0-OpenSSH_5 Trisquel-5.5')
         self.client_protocol = client_protocol
         self.server_protocol = server_protocol
-        self.client_algos = client_algos # None or dict
-        self.server_algos = server_algos # None or dict
-        self.client_sent_nb_datagrams = sum(1 for p in self.datagrams
-                                         if p.sent_by_client)
-        self.server_sent_nb_datagrams = sum(1 for p in self.datagrams
-                                         if not p.sent_by_client)
-        self.client_sent_len = sum(p.total_len for p in self.datagrams
-                                 if p.sent_by_client)
-        self.server_sent_len = sum(p.total_len for p in self.datagrams
-                                 if not p.sent_by_client)
+        # None or Kexinit instance, shared by the connections with the same
+        # algorithms
+        self.client_algos = client_algos
+        self.server_algos = server_algos
+        # None (computed from the datagrams when needed) or tuple
+        # (client_sent_nb_datagrams, client_sent_len,
+        #  server_sent_nb_datagrams, server_sent_len)
+        self._sent_stats = sent_stats
         self.ssh = is_ssh
+        self._features = None
+        self.sensor = None # name of the capture, when several are merged
+
+    @property
+    def datagrams(self):
+        """List of Datagram instances, loaded on first access"""
+        if self._datagrams is None:
+            self.logger.debug('Loading datagrams')
+            self._datagrams = self.datagrams_loader() \
+                    if self.datagrams_loader is not None else []
+            if self.rtt_on_load:
+                try:
+                    self.compute_rtt()
+                except BaseException:
+                    # e.g. TimeBudgetExceeded: not left half computed
+                    self._datagrams = None
+                    raise
+        return self._datagrams
+
+    @property
+    def features(self):
+        """Features of the datagrams shared by the plugins"""
+        if self._features is None:
+            self._features = DatagramsFeatures(self.datagrams)
+        return self._features
+
+    def datagrams_loaded(self):
+        """Are the datagrams currently in memory?"""
+        return self._datagrams is not None
+
+    def release_datagrams(self):
+        """
+        Free the datagrams; they will be loaded again if needed
+
+        Does nothing if the datagrams can not be loaded again
+        """
+        if self.datagrams_loader is not None:
+            self._datagrams = None
+            self._features = None
+
+    def sent_stats(self):
+        """
+        Return (client_sent_nb_datagrams, client_sent_len,
+        server_sent_nb_datagrams, server_sent_len)
+        """
+        if self._sent_stats is None:
+            client = [p.total_len for p in self.datagrams if p.sent_by_client]
+            server = [p.total_len for p in self.datagrams
+                      if not p.sent_by_client]
+            self._sent_stats = (len(client), sum(client),
+                                len(server), sum(server))
+        return self._sent_stats
+
+    client_sent_nb_datagrams = property(lambda self: self.sent_stats()[0])
+    client_sent_len = property(lambda self: self.sent_stats()[1])
+    server_sent_nb_datagrams = property(lambda self: self.sent_stats()[2])
+    server_sent_len = property(lambda self: self.sent_stats()[3])
+
+    def sample(self, max_datagrams, sampling='first'):
+        """
+        Copy of the connection keeping at most max_datagrams datagrams:
+        the first ones, the last ones or uniformly chosen ones, according to
+        sampling ('first', 'last' or 'uniform')
+
+        Return the connection itself if it has no more datagrams
+        """
+        datagrams = self.datagrams
+        if sampling not in SAMPLINGS:
+            raise ValueError('Unknown sampling %s' % sampling)
+        if len(datagrams) <= max_datagrams:
+            return self
+        if sampling == 'first':
+            datagrams = datagrams[:max_datagrams]
+        elif sampling == 'last':
+            datagrams = datagrams[-max_datagrams:] if max_datagrams else []
+        else: # uniform
+            step = float(len(datagrams)) / max_datagrams
+            datagrams = [datagrams[int(i * step)]
+                         for i in xrange(max_datagrams)]
+        sample = copy.copy(self)
+        sample._datagrams = datagrams
+        sample.datagrams_loader = None
+        sample._sent_stats = None
+        sample._features = None
+        if datagrams:
+            sample.start_time = datagrams[0].time
+            sample.duration = datagrams[-1].time - datagrams[0].time
+        return sample
+
+    def shift_time(self, offset):
+        """
+        Move the connection and its datagrams in time by offset (a timedelta),
+        e.g. to correct the clock of its capture
+        """
+        self.start_time += offset
+        if self._datagrams is not None:
+            for datagram in self._datagrams:
+                datagram.time += offset
+            self._features = None
+        if self.datagrams_loader is not None:
+            self.datagrams_loader = partial(shifted_datagrams,
+                                            self.datagrams_loader, offset)
 
     def __repr__(self):
         return '<Connection %d>' % self.nb
@@ -100,6 +245,7 @@ class Connection:
 
     def compute_rtt(self):
         """Set an approximate RTT for each datagram in self.datagrams"""
+        self._features = None # RTTs are to be changed
         # Step1: compute RTT for the very last packet being acked
         # (ignore multiple acks in one)
         self.datagrams.reverse()
@@ -170,6 +316,86 @@ class Connection:
                 d.rtt = last_rtt[way]
 
 
+class DatagramsFeatures:
+    """
+    Features of a list of datagrams, each computed on first use
+
+    For the methods having a way argument, way is True for the datagrams sent
+    by the client, False for the ones sent by the server, and None for all of
+    them. Only the datagrams with a payload are considered.
+    """
+
+    def __init__(self, datagrams):
+        self.datagrams = datagrams
+        self._cache = {}
+
+    def _payload_pass(self):
+        """Compute the features needing a pass over all the datagrams"""
+        indices = {None: [], True: [], False: []}
+        payload_sums = {True: 0, False: 0}
+        for i, datagram in enumerate(self.datagrams):
+            if datagram.payload_len:
+                indices[None].append(i)
+                indices[datagram.sent_by_client].append(i)
+                payload_sums[datagram.sent_by_client] += datagram.payload_len
+        self._cache['payload_indices'] = indices
+        self._cache['payload_sums'] = payload_sums
+
+    def _get(self, feature, way, compute):
+        """Get a feature, compute it with compute(way) if needed"""
+        key = (feature, way)
+        if key not in self._cache:
+            self._cache[key] = compute(way)
+        return self._cache[key]
+
+    def payload_indices(self, way=None):
+        """Indices of the datagrams with a payload"""
+        if 'payload_indices' not in self._cache:
+            self._payload_pass()
+        return self._cache['payload_indices'][way]
+
+    def payload_sums(self):
+        """Total payload length sent by the client (True) and server (False)"""
+        if 'payload_sums' not in self._cache:
+            self._payload_pass()
+        return self._cache['payload_sums']
+
+    def payload_datagrams(self, way=None):
+        """Datagrams with a payload"""
+        return self._get('payload_datagrams', way, lambda way:
+                [self.datagrams[i] for i in self.payload_indices(way)])
+
+    def times_us(self, way=None):
+        """Times of the datagrams, in microseconds since EPOCH"""
+        return self._get('times_us', way, lambda way:
+                [td_us(d.time - EPOCH) for d in self.payload_datagrams(way)])
+
+    def times(self, way=None):
+        """Times of the datagrams, in seconds since EPOCH"""
+        return self._get('times', way, lambda way:
+                [t / 1000000. for t in self.times_us(way)])
+
+    def iats(self, way=None):
+        """Inter-arrival times between the datagrams, in seconds"""
+        def compute(way):
+            times = self.times_us(way)
+            return [(t2 - t1) / 1000000. for t1, t2 in zip(times, times[1:])]
+        return self._get('iats', way, compute)
+
+    def rtts(self, way=None):
+        """RTTs of the datagrams, in seconds (see Connection.compute_rtt)"""
+        return self._get('rtts', way, lambda way:
+                [d.rtt.total_seconds() for d in self.payload_datagrams(way)])
+
+
+def shifted_datagrams(loader, offset):
+    """Datagrams returned by loader, moved in time by offset"""
+    datagrams = loader()
+    for datagram in datagrams:
+        datagram.time += offset
+    return datagrams
+
+
 class Datagram:
     """A datagram of a ssh connection"""
 
@@ -207,61 +433,187 @@ class Datagram:
         return repr(self)
 
 
+class TimeBudgetExceeded(BaseException):
+    """
+    Raised when the analyse of a connection by a plugin takes too long
+
+    Not an Exception, so that the plugins do not catch it by mistake
+    """
+    pass
+
+@contextmanager
+def time_budget(seconds):
+    """Raise TimeBudgetExceeded in the block after seconds (if not None)"""
+    if seconds is None or not hasattr(signal, 'setitimer'):
+        yield
+        return
+    def handler(signum, frame):
+        raise TimeBudgetExceeded()
+    previous_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
 class ConnectionsRepr:
     """Representation of connection, one after the other"""
 
-    def __init__(self, logger, full, plugins):
+    def __init__(self, logger, full, plugins, cache=None):
         self.logger = logger
+        self.cache = cache # ResultCache instance, or None
         self.plugins = []
         self.plugins_fields = {}
         self.plugins_fields_table = {}
+        self.batch_results = {} # results of the plugins computed by prepare
+        # field of the results of the analyses stopped by a budget
+        self.partial_fields = {}
         if plugins:
             for plugin in plugins:
                 try:
                     fields = plugin.plugin_object.result_fields()
+                    if self.has_budget(plugin):
+                        self.partial_fields[plugin] = \
+                                'Partial analyse (%s)' % plugin.name
+                        fields = tuple(fields) + (self.partial_fields[plugin],)
                     fields_table = plugin.plugin_object.result_fields_table()
+                    self.logger.debug('Activate the plugin %s' % plugin.name)
+                    plugin.plugin_object.activate()
                 except Exception as e:
-                    if e.message:
-                        self.logger.error('Plugin %s fatal error: %s, %s' %
-                                (plugin.name, e.__class__.__name__, e.message))
-                    else:
-                        self.logger.error('Plugin %s fatal error: %s' %
-                                (plugin.name, e.__class__.__name__))
+                    self.plugin_error(plugin, e, 'fatal error')
                 else:
                     self.plugins.append(plugin)
                     self.plugins_fields[plugin] = fields
                     self.plugins_fields_table[plugin] = fields_table
+                    self.batch_results[plugin] = {}
         self.full = full
 
+    def close(self):
+        """Deactivate the plugins once all connections are represented"""
+        for plugin in self.plugins:
+            try:
+                self.logger.debug('Deactivate the plugin %s' % plugin.name)
+                plugin.plugin_object.deactivate()
+            except Exception as e:
+                self.plugin_error(plugin, e, 'crash')
+        self.plugins = []
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
+
+    def plugin_error(self, plugin, e, what):
+        """Log an exception raised by a plugin"""
+        if e.message:
+            self.logger.error('Plugin %s %s: %s, %s' %
+                    (plugin.name, what, e.__class__.__name__, e.message))
+        else:
+            self.logger.error('Plugin %s %s: %s' %
+                    (plugin.name, what, e.__class__.__name__))
+
+    def has_budget(self, plugin):
+        """Is the analyse of a connection by a plugin limited?"""
+        return plugin.plugin_object.TIME_BUDGET is not None \
+                or plugin.plugin_object.MAX_DATAGRAMS is not None
+
     def repr(self, connection):
         """Representation of a connection"""
         raise NotImplementedError()
 
-    def result_plugin(self, connection, plugin):
-        """Apply and represent a plugin on a connection"""
-        s = {}
+    def batch_size(self):
+        """Number of connections to give at once to prepare"""
+        return max([plugin.plugin_object.batch_size
+                    for plugin in self.plugins] + [1])
+
+    def prepare(self, connections):
+        """
+        Analyse the next connections to represent at once with the plugins
+        supporting it (see analyse_batch)
+        """
+        if not self.full:
+            return
+        for plugin in self.plugins:
+            if self.has_budget(plugin):
+                continue # the budgets apply to each connection
+            if plugin.plugin_object.batch_size <= 1:
+                continue # analysed one by one anyway
+            todo = connections
+            if self.cache is not None:
+                # results already in the cache are not computed again
+                todo = [connection for connection in connections
+                        if (connection, plugin) not in self.cache]
+                if not todo:
+                    continue
+            self.logger.info('Analyse %d connections with plugin %s' \
+                    % (len(todo), plugin.name))
+            try:
+                results = plugin.plugin_object.analyse_batch(todo)
+            except Exception as e:
+                self.plugin_error(plugin, e, 'crash')
+            else:
+                if results is not None:
+                    self.batch_results[plugin] = results
+
+    def analyse(self, connection, plugin):
+        """
+        Apply a plugin on a connection, return its result (a dictionary, or
+        the RuntimeWarning raised by the plugin)
+        """
+        if connection in self.batch_results[plugin]:
+            # already analysed by prepare
+            return self.batch_results[plugin].pop(connection)
         plugin_object = plugin.plugin_object
         self.logger.info('Analyse connection %d with plugin %s' \
                 % (connection.nb, plugin.name))
+        partial = None
         try:
-            self.logger.debug('Activate the plugin')
-            plugin_object.activate()
-            self.logger.debug('Launch the analyse of the connection'
-                    ' by the plugin')
-            plugin_object.analyse(connection)
-            self.logger.debug('Get the result of the analyse by the plugin')
-            s = plugin_object.result_repr()
-            self.logger.debug('Deactivate the plugin')
-            plugin_object.deactivate()
+            with time_budget(plugin_object.TIME_BUDGET):
+                # the datagrams are loaded (and sampled) within the budget
+                if plugin_object.MAX_DATAGRAMS is not None:
+                    sample = connection.sample(plugin_object.MAX_DATAGRAMS,
+                                               plugin_object.SAMPLING)
+                    if sample is not connection:
+                        partial = '%s %d of %d datagrams' % (
+                                plugin_object.SAMPLING, len(sample.datagrams),
+                                len(connection.datagrams))
+                        connection = sample
+                self.logger.debug('Launch the analyse of the connection'
+                        ' by the plugin')
+                plugin_object.analyse(connection)
+                self.logger.debug('Get the result of the analyse by the'
+                        ' plugin')
+                s = plugin_object.result_repr()
         except RuntimeWarning as e:
+            return e
+        if partial is not None:
+            s[self.partial_fields[plugin]] = partial
+        return s
+
+    def result_plugin(self, connection, plugin):
+        """Apply and represent a plugin on a connection"""
+        s = None
+        try:
+            if self.cache is not None:
+                s = self.cache.get(connection, plugin)
+            if s is None:
+                s = self.analyse(connection, plugin)
+                if self.cache is not None:
+                    self.cache.set(connection, plugin, s)
+            if isinstance(s, RuntimeWarning):
+                raise s
+        except TimeBudgetExceeded:
+            # not stored in the cache: the next run may be faster
+            self.logger.warning('Plugin %s: analyse of connection %d'
+                    ' interrupted' % (plugin.name, connection.nb))
+            s = {self.partial_fields[plugin]: 'interrupted after %gs'
+                    % plugin.plugin_object.TIME_BUDGET}
+        except RuntimeWarning as e:
+            s = {}
             self.logger.warning('Plugin %s: %s' % (plugin.name, e.message))
         except Exception as e:
-            if e.message:
-                self.logger.error('Plugin %s crash: %s, %s' %
-                        (plugin.name, e.__class__.__name__, e.message))
-            else:
-                self.logger.error('Plugin %s crash: %s' %
-                        (plugin.name, e.__class__.__name__))
+            s = {}
+            self.plugin_error(plugin, e, 'crash')
         return s
 
 class ConnectionsNormalRepr(ConnectionsRepr):
@@ -279,7 +631,7 @@ class ConnectionsNormalRepr(ConnectionsRepr):
         r = (
              'Connection %d: ' + C.FBlu + '%s' + C.FRes + ':' + C.FCya + '%d'
              + C.FRes + ' --> ' + C.FYel + '%s' + C.FRes + ':' + C.FGre
-             + '%d' + C.FRes + '\n%s'
+             + '%d' + C.FRes + '\n%s%s'
              'Start date: %s\n'
              'Duration: %s\n'
              'Datagrams sent by client: ' + C.FBlu + '%d ' + C.FRes + '(' +
@@ -291,6 +643,8 @@ class ConnectionsNormalRepr(ConnectionsRepr):
                 connection.server_ip, connection.server_port,
                 '' if connection.ssh else C.FMag +
                     'Not detected as a ssh connection' + C.FRes + '\n',
+                '' if connection.sensor is None else
+                    'Sensor: %s\n' % connection.sensor,
                 connection.start_time.strftime('%b %d, %Y - %H:%M:%S'),
                 str_td(connection.duration),
                 connection.client_sent_nb_datagrams, connection.client_sent_len,
@@ -333,12 +687,14 @@ class ConnectionsTableRepr(ConnectionsNormalRepr):
         t.add_row(['Datagrams (bytes)', connection.client_sent_len,
             connection.server_sent_len])
         r = (
-             'Connection %d\n%s'
+             'Connection %d\n%s%s'
              'Start date: %s\n'
              'Duration: %s'
             ) % (
                 connection.nb, '' if connection.ssh else C.FMag +
                     'Not detected as a ssh connection' + C.FRes + '\n',
+                '' if connection.sensor is None else
+                    'Sensor: %s\n' % connection.sensor,
                 connection.start_time.strftime('%b %d, %Y - %H:%M:%S'),
                 str_td(connection.duration)
             )
@@ -367,15 +723,11 @@ class ConnectionsTableRepr(ConnectionsNormalRepr):
         r += '\n%s' % t.draw()
         print '%s\n' % r.replace('\n', '\n  ')
 
-# Failback to ConnectionsNormalRepr if Texttable was not imported properly
-if Texttable is None:
-    ConnectionsTableRepr = ConnectionsNormalRepr
-
 class ConnectionsCSVRepr(ConnectionsRepr):
     """Representation of a connection as CSV"""
 
-    def __init__(self, logger, full, plugins, csv_writer):
-        ConnectionsRepr.__init__(self, logger, full, plugins)
+    def __init__(self, logger, full, plugins, csv_writer, cache=None):
+        ConnectionsRepr.__init__(self, logger, full, plugins, cache)
         self.csv_writer = csv_writer
         columns = ['Connection nb', 'Detected as SSH', 'Source IP',
             'Source port','Destination IP', 'Destinantion port', 'Start date']
@@ -466,6 +818,114 @@ class TestConnection(unittest.TestCase):
             self.assertGreaterEqual(datagram.rtt.total_seconds(), 0.1)
             self.assertLessEqual(datagram.rtt.total_seconds(), 0.9)
 
+    def test_lazy_datagrams(self):
+        """Datagrams are loaded on first use, and can be released"""
+        datagrams = self.create_connection().datagrams
+        loads = []
+        def loader():
+            loads.append(None)
+            return list(datagrams)
+        connection = Connection(0, None, datetime.now(), timedelta(0),
+                '1.2.3.4', '5.6.7.8', 12345, 22, None, None, {}, {}, True,
+                loader)
+        connection.rtt_on_load = True
+        self.assertFalse(connection.datagrams_loaded())
+        self.assertEqual(len(loads), 0)
+        self.assertEqual(connection.client_sent_nb_datagrams
+                + connection.server_sent_nb_datagrams, len(datagrams))
+        self.assertEqual(len(loads), 1)
+        self.assertIsNotNone(connection.datagrams[0].rtt)
+        connection.release_datagrams()
+        self.assertFalse(connection.datagrams_loaded())
+        self.assertEqual(len(connection.datagrams), len(datagrams))
+        self.assertEqual(len(loads), 2)
+
+    def test_features(self):
+        """Features match the ones computed from the datagrams"""
+        connection = self.create_connection()
+        connection.compute_rtt()
+        features = connection.features
+        client = [d for d in connection.datagrams if d.sent_by_client]
+        self.assertEqual(features.payload_datagrams(True), client)
+        self.assertEqual(features.payload_sums()[True],
+                         sum(d.payload_len for d in client))
+        self.assertEqual(features.rtts(True),
+                         [d.rtt.total_seconds() for d in client])
+        for iat, d1, d2 in zip(features.iats(True), client, client[1:]):
+            self.assertAlmostEqual(iat, (d2.time - d1.time).total_seconds())
+        self.assertIs(connection.features.iats(True), features.iats(True))
+
+    def test_sample(self):
+        """Samples keep at most the given number of datagrams"""
+        connection = self.create_connection()
+        datagrams = connection.datagrams
+        self.assertIs(connection.sample(10000), connection)
+        self.assertEqual(connection.sample(100).datagrams, datagrams[:100])
+        self.assertEqual(connection.sample(100, 'last').datagrams,
+                         datagrams[-100:])
+        sample = connection.sample(100, 'uniform')
+        self.assertEqual(sample.datagrams, datagrams[::100])
+        self.assertEqual(sample.duration,
+                         datagrams[9900].time - datagrams[0].time)
+        self.assertIs(connection.datagrams, datagrams)
+
+    def test_shift_time(self):
+        """Loaded and reloaded datagrams are moved in time"""
+        datagrams = self.create_connection().datagrams
+        times = [datagram.time for datagram in datagrams]
+        connection = Connection(0, None, times[0], timedelta(0),
+                '1.2.3.4', '5.6.7.8', 12345, 22, None, None, {}, {}, True,
+                lambda: [copy.copy(datagram) for datagram in datagrams])
+        connection.datagrams
+        connection.shift_time(timedelta(seconds=-2))
+        connection.shift_time(timedelta(seconds=3))
+        self.assertEqual(connection.start_time, times[0] + timedelta(seconds=1))
+        for _ in xrange(2):
+            self.assertEqual([datagram.time for datagram in
+                              connection.datagrams],
+                             [time + timedelta(seconds=1) for time in times])
+            connection.release_datagrams()
+
+    def test_time_budget(self):
+        """Long computations are interrupted"""
+        start = time.time()
+        def loop():
+            with time_budget(0.05):
+                while True:
+                    pass
+        self.assertRaises(TimeBudgetExceeded, loop)
+        self.assertLess(time.time() - start, 1)
+        with time_budget(None):
+            pass
+
+    def test_prepare_cache(self):
+        """Each plugin analyses the connections not cached for it"""
+        class FakePlugin(object):
+            TIME_BUDGET = None
+            MAX_DATAGRAMS = None
+            batch_size = 256
+            def __init__(self, name):
+                self.name = name
+                self.plugin_object = self
+                self.analysed = []
+            def result_fields(self):
+                return ()
+            def result_fields_table(self):
+                return []
+            def activate(self):
+                pass
+            def analyse_batch(self, connections):
+                self.analysed.extend(connections)
+                return {}
+        plugins = [FakePlugin('first'), FakePlugin('second')]
+        # the first plugin has a result for 1, the second one for 2
+        cached = set([(1, plugins[0]), (2, plugins[1])])
+        connections_repr = ConnectionsRepr(logging.getLogger('Test'), True,
+                                           plugins, cached)
+        connections_repr.prepare([1, 2, 3])
+        self.assertEqual(plugins[0].analysed, [2, 3])
+        self.assertEqual(plugins[1].analysed, [1, 3])
+
 
 if __name__ == '__main__':
     import sys
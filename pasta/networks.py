@@ -0,0 +1,202 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Sets of networks (CIDR notation, IPv4 and IPv6), to select the connections
+by their addresses
+"""
+
+
+import socket, unittest, tempfile, os
+from binascii import hexlify
+
+
+def parse_address(address):
+    """Family (AF_INET or AF_INET6), number of bits and value of an address"""
+    family, bits = (socket.AF_INET6, 128) if ':' in address \
+            else (socket.AF_INET, 32)
+    try:
+        return (family, bits,
+                int(hexlify(socket.inet_pton(family, address.strip())), 16))
+    except (socket.error, UnicodeError):
+        raise ValueError('not a valid address: %s' % address)
+
+
+class PrefixTree:
+    """
+    Set of networks, as a binary radix tree of their prefixes per address
+    family: an address is in the set if a prefix of its bits is
+    """
+
+    def __init__(self, networks=()):
+        # nodes are lists [child for bit 0, child for bit 1, end of a prefix]
+        self.roots = {socket.AF_INET: [None, None, False],
+                      socket.AF_INET6: [None, None, False]}
+        self.size = 0
+        for network in networks:
+            self.add(network)
+
+    def add(self, network):
+        """Add a network (e.g. '192.168.0.0/16', or an address)"""
+        address, _, prefix = network.partition('/')
+        family, bits, value = parse_address(address)
+        try:
+            prefix = int(prefix) if prefix else bits
+        except ValueError:
+            prefix = -1
+        if not 0 <= prefix <= bits:
+            raise ValueError('not a valid prefix length: %s' % network)
+        node = self.roots[family]
+        for shift in xrange(bits - 1, bits - 1 - prefix, -1):
+            if node[2]:
+                # already in a larger network
+                return
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        if not node[2]:
+            # includes the smaller networks, which are not counted anymore
+            self.size += 1 - self.count(node)
+            node[:] = [None, None, True]
+
+    @staticmethod
+    def count(node):
+        """Number of ends of prefixes in the subtree of a node"""
+        count = 0
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            if node[2]:
+                count += 1
+            else:
+                nodes.extend(child for child in node[:2] if child is not None)
+        return count
+
+    def __contains__(self, address):
+        """Is the address (a string) in one of the networks?"""
+        try:
+            family, bits, value = parse_address(address)
+        except ValueError:
+            return False
+        node = self.roots[family]
+        for shift in xrange(bits - 1, -1, -1):
+            if node[2]:
+                return True
+            node = node[(value >> shift) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+    def __len__(self):
+        """Number of networks (not included in another one)"""
+        return self.size
+
+
+def load_networks(file_name):
+    """
+    Read a file of networks, one per line (empty lines and the text after
+    '#' are ignored); return a PrefixTree
+
+    Raise IOError if the file can not be read, ValueError for an invalid line
+    """
+    networks = PrefixTree()
+    with open(file_name) as networks_file:
+        for number, line in enumerate(networks_file, 1):
+            line = line.partition('#')[0].strip()
+            if line:
+                try:
+                    networks.add(line)
+                except ValueError as e:
+                    raise ValueError('line %d: %s' % (number, e))
+    return networks
+
+
+class TestPrefixTree(unittest.TestCase):
+    """Unit tests for PrefixTree"""
+
+    def test_contains(self):
+        """Addresses in the networks"""
+        networks = PrefixTree(['10.0.0.0/8', '192.168.1.7', '2001:db8::/32',
+                               '10.1.0.0/16'])
+        self.assertEqual(len(networks), 3)
+        self.assertIn('10.20.30.40', networks)
+        self.assertIn('192.168.1.7', networks)
+        self.assertNotIn('192.168.1.8', networks)
+        self.assertNotIn('11.0.0.1', networks)
+        self.assertIn('2001:db8:1::42', networks)
+        self.assertNotIn('2001:db9::1', networks)
+        self.assertNotIn('not an address', networks)
+        self.assertIn('1.2.3.4', PrefixTree(['0.0.0.0/0']))
+        self.assertRaises(ValueError, PrefixTree, ['10.0.0.0/33'])
+        self.assertRaises(ValueError, PrefixTree, ['10.0.0/8'])
+
+    def test_len(self):
+        """Networks included in another one are not counted"""
+        for networks in (['10.0.0.0/8', '10.1.0.0/16', '10.2.0.1'],
+                         ['10.1.0.0/16', '10.2.0.1', '10.0.0.0/8']):
+            self.assertEqual(len(PrefixTree(networks)), 1)
+        self.assertEqual(len(PrefixTree(['10.1.0.0/16', '10.1.2.0/24',
+                                         '10.2.0.0/16', '10.0.0.0/14',
+                                         '::1', '::/127'])), 2)
+
+    def test_scan(self):
+        """Same results as scanning the networks"""
+        import random
+        networks = [(random.getrandbits(32), random.randint(8, 32))
+                    for _ in xrange(200)]
+        to_address = lambda value: socket.inet_ntoa(
+                ('%08x' % value).decode('hex'))
+        tree = PrefixTree('%s/%d' % (to_address(value >> (32 - prefix)
+                                                << (32 - prefix)), prefix)
+                          for value, prefix in networks)
+        for _ in xrange(2000):
+            value = random.choice((random.getrandbits(32),
+                                   random.choice(networks)[0]))
+            self.assertEqual(to_address(value) in tree,
+                             any(value >> (32 - prefix) == network
+                                 >> (32 - prefix)
+                                 for network, prefix in networks))
+
+    def test_load(self):
+        """Networks read from a file"""
+        handle, file_name = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as networks_file:
+                networks_file.write('# our servers\n10.0.0.0/24\n\n'
+                                    '::1 # localhost\n')
+            networks = load_networks(file_name)
+            self.assertIn('10.0.0.3', networks)
+            self.assertIn('::1', networks)
+            with open(file_name, 'a') as networks_file:
+                networks_file.write('10.0.0.0/42\n')
+            self.assertRaises(ValueError, load_networks, file_name)
+        finally:
+            os.remove(file_name)
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
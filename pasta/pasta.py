@@ -24,11 +24,18 @@ Parse the arguments and launch PASTA according to them
 
 
 if __name__ == '__main__':
-    import sys, argparse, logging, os, csv
+    import sys, argparse, logging, os, csv, anydbm
+    from datetime import datetime
     import colors as C
     from pcap_parser import PcapParser
+    from plugin_registry import PluginRegistry, plugin_key
+    from result_cache import ResultCache
+    from sensors import Sensor, merge
+    from time_index import TimeIndex
+    from networks import load_networks
     from connection import ConnectionsNormalRepr, ConnectionsCSVRepr, \
-            ConnectionsTableRepr
+            ConnectionsTableRepr, load_texttable, DATAGRAMS_FIELDS, TIMES, \
+            SEQ_ACK, RTT
 
     # Check the right version of Python
     if sys.version_info[:2] != (2, 7):
@@ -36,35 +43,23 @@ if __name__ == '__main__':
         sys.exit(1)
 
     # Load the plugins on demand
-    def load_plugins(parser, logger=None):
-        """Load all plugins"""
-        # import yapsy if needed
-        try:
-            from yapsy.PluginManager import PluginManager
-        except ImportError:
-            parser.exit(status=3, message='PASTA plugins require yapsy.\n'
-                'See README file for more informations.\n'
-                'Alternatively, use the option --no-plugins to disable the'
-                ' plugins\n')
-        from plugins import SingleConnectionAnalyser, \
-                InterConnectionsAnalyser
-        # create the plugin manager
-        plugin_manager = PluginManager(
-                categories_filter={
-                        'SingleConnectionAnalyser': SingleConnectionAnalyser,
-                        'InterConnectionsAnalyser': InterConnectionsAnalyser
-                    },
-                directories_list = [os.path.join(os.path.dirname(sys.argv[0]),
-                        'plugins')],
-                plugin_info_ext='plugin')
-        plugin_manager.locatePlugins()
-        def load_plugin(plugin):
-            """A plugin is being loaded"""
-            if logger is not None:
+    def load_plugins(parser, logger=None, selected=None, excluded=None):
+        """
+        Find the plugins (they are imported when first used)
+
+        Only the plugins in selected (if not None) and not in excluded are
+        kept; plugins are identified by their name or module (see plugin_key)
+        """
+        plugin_registry = PluginRegistry()
+        unknown = plugin_registry.select(selected, excluded)
+        if unknown:
+            parser.error('unknown plugin(s): %s; see --list-plugins'
+                         % ', '.join(sorted(unknown)))
+        if logger is not None:
+            for plugin in plugin_registry.all_plugins():
                 logger.info('...plugin %s v.%s'
                         % (plugin.name, plugin.version))
-        plugin_manager.loadPlugins(load_plugin)
-        return plugin_manager
+        return plugin_registry
 
     # Define an argparse type for range of numbers
     def argparse_numbers(txt):
@@ -83,6 +78,57 @@ if __name__ == '__main__':
                 raise argparse.ArgumentTypeError('not a valid argument')
         return numbers
 
+    # Define an argparse type for a date
+    def argparse_date(txt):
+        """Is txt a valid date (e.g. 2012-05-01 12:00:00)?"""
+        for date_format in ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                            '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+            try:
+                return datetime.strptime(txt.strip(), date_format)
+            except ValueError:
+                pass
+        raise argparse.ArgumentTypeError('not a valid date')
+
+    # Define an argparse type for a period
+    def argparse_period(txt):
+        """Is txt a valid period (two dates separated by a comma)?"""
+        dates = txt.split(',')
+        if len(dates) != 2:
+            raise argparse.ArgumentTypeError('not a valid period')
+        start, end = [argparse_date(date) for date in dates]
+        if end < start:
+            raise argparse.ArgumentTypeError('the period ends before its'
+                                             ' start')
+        return (start, end)
+
+    # Define an argparse type for a number of processes
+    def argparse_jobs(txt):
+        """Is txt a valid number of processes?"""
+        try:
+            jobs = int(txt)
+        except ValueError:
+            raise argparse.ArgumentTypeError('not a valid argument')
+        if jobs < 1:
+            raise argparse.ArgumentTypeError('at least one process is needed')
+        return jobs
+
+    # Define an argparse type for list of plugins
+    def argparse_plugins(txt):
+        """Is txt a valid list of plugins?"""
+        plugins = set(plugin_key(name) for name in txt.split(','))
+        if '' in plugins:
+            raise argparse.ArgumentTypeError('not a valid argument')
+        return plugins
+
+    # Define an argparse type for the options of the plugins
+    def argparse_plugin_option(txt):
+        """Is txt a valid plugin option (plugin.option=value)?"""
+        name, sep, value = txt.partition('=')
+        plugin, dot, option = name.rpartition('.')
+        if not sep or not dot or not plugin_key(plugin) or not option:
+            raise argparse.ArgumentTypeError('not a valid argument')
+        return (plugin_key(plugin), option.strip(), value.strip())
+
     # Usage
     class PastaFormatter(argparse.RawDescriptionHelpFormatter):
         """Argparse formatter to separate some options in the usage"""
@@ -130,11 +176,34 @@ if __name__ == '__main__':
     main_options = parser.add_argument_group('Main options')
     main_options.add_argument('-r', metavar='file.pcap', dest='inputFile',
                         required=True, help='filename to read from')
+    main_options.add_argument('--sensor', metavar='file.pcap',
+                              dest='sensor_files', default=[], action='append',
+                              help='capture made at another sensor, merged'
+                              ' with the first one once the clocks are'
+                              ' corrected; may be repeated')
     main_options.add_argument('-n', metavar='nb', dest='connection_nb',
                               type=argparse_numbers, help='procede only these '
                               'connections (e.g.: 2,4-6 shows only the second,'
                               ' fourth, fifth and sixth connections);'
                               ' implies -S')
+    group_active = main_options.add_mutually_exclusive_group()
+    group_active.add_argument('--active-at', metavar='date', dest='active_at',
+                              type=argparse_date, help='keep only the'
+                              ' connections active at this date (e.g.'
+                              ' "2012-05-01 12:00:00")')
+    group_active.add_argument('--active-between', metavar='start,end',
+                              dest='active_between', type=argparse_period,
+                              help='keep only the connections active during'
+                              ' a part of this period')
+    main_options.add_argument('--include-nets', metavar='file',
+                              dest='include_nets', help='keep only the'
+                              ' connections of which the client or the server'
+                              ' is in one of the networks of the file (one'
+                              ' per line, e.g. 10.0.0.0/8 or 2001:db8::/32)')
+    main_options.add_argument('--exclude-nets', metavar='file',
+                              dest='exclude_nets', help='ignore the'
+                              ' connections of which the client or the server'
+                              ' is in one of the networks of the file')
     main_options.add_argument('-a', '--all', dest='ssh_only',
                               action='store_false', help='keep connections '
                               'which do not look like ssh (slower)')
@@ -169,6 +238,30 @@ if __name__ == '__main__':
                                dest='list_plugins', help='list the plugins')
     plugins_options.add_argument('--no-plugins', action='store_false',
                                dest='plugins', help='disactivate all plugins')
+    plugins_options.add_argument('--plugins', metavar='names',
+                               dest='plugins_selected', type=argparse_plugins,
+                               help='use only these plugins (e.g.: '
+                               'algorithms,connection_type); see'
+                               ' --list-plugins for the names')
+    plugins_options.add_argument('--exclude-plugins', metavar='names',
+                               dest='plugins_excluded', type=argparse_plugins,
+                               help='do not use these plugins')
+    plugins_options.add_argument('--plugin-option', metavar='plugin.option='
+                               'value', dest='plugin_options', default=[],
+                               action='append', type=argparse_plugin_option,
+                               help='change an option of a plugin, e.g.'
+                               ' time_budget (in seconds), max_datagrams and'
+                               ' sampling (first, last or uniform) limit the'
+                               ' analyse of each connection; may be repeated')
+    plugins_options.add_argument('-j', '--jobs', metavar='nb', dest='jobs',
+                               type=argparse_jobs, default=None,
+                               help='number of processes comparing the'
+                               ' connections in the inter-connections'
+                               ' plugins (default: 1)')
+    plugins_options.add_argument('--cache', metavar='file', dest='cache_file',
+                               default=None, help='keep the results of the'
+                               ' plugins in a file, so that they are not'
+                               ' computed again by the next runs')
 
     logging_options = parser.add_argument_group('Logging options')
     logging_options.add_argument('-v', '--verbose', dest='verbose',
@@ -192,11 +285,11 @@ if __name__ == '__main__':
     if args.list_plugins:
         # disable loggin
         logging.disable(logging.ERROR)
-        # we just want to print the list of plugins
-        plugin_manager = load_plugins(parser)
-        for category in plugin_manager.getCategories():
+        # we just want to print the list of all the plugins
+        plugin_registry = PluginRegistry()
+        for category in plugin_registry.categories():
             print ''
-            plugins = plugin_manager.getPluginsOfCategory(category)
+            plugins = plugin_registry.plugins_of_category(category)
             if len(plugins) == 0:
                 print 'No plugin detected in category %s.' % category
             if len(plugins) == 1:
@@ -205,8 +298,15 @@ if __name__ == '__main__':
                 print '%s plugins detected in category %s:' \
                     % (len(plugins), category)
             for plugin in plugins:
-                print '\n  %s v.%s' % (plugin.name, plugin.version)
+                print '\n  %s v.%s (%s)' % (plugin.name, plugin.version,
+                        plugin.module)
                 print '    %s' % '\n    '.join(plugin.description.split('\n'))
+                missing = plugin.missing_requires()
+                if not plugin.default:
+                    print '    Not used by default (use --plugins)'
+                elif missing:
+                    print '    Not used by default: %s missing (use' \
+                            ' --plugins)' % ', '.join(missing)
             print ''
         sys.exit(0)
     # then, the remaining
@@ -274,48 +374,148 @@ if __name__ == '__main__':
     # Loading plugins
     if args.plugins or args.list_plugins:
         logger.info('Loading plugins...')
-        plugin_manager = load_plugins(parser, logger)
+        plugin_registry = load_plugins(parser, logger, args.plugins_selected,
+                args.plugins_excluded)
     else:
         logger.info('Plugins disabled')
 
+    # Options of the plugins
+    if args.plugins and args.jobs is not None:
+        logger.info('Inter-connections plugins use %d processes' % args.jobs)
+        for plugin in plugin_registry.plugins_of_category(
+                'InterConnectionsAnalyser'):
+            plugin.plugin_object.JOBS = args.jobs
+    for plugin_name, option, value in args.plugin_options:
+        if not args.plugins:
+            break
+        for plugin in plugin_registry.all_plugins():
+            if plugin_name in plugin.keys():
+                logger.info('Plugin %s: set %s to %s'
+                            % (plugin.name, option, value))
+                try:
+                    plugin.set_option(option, value)
+                except ValueError as e:
+                    parser.error('--plugin-option: %s.%s: %s'
+                                 % (plugin_name, option, e))
+                break
+        else:
+            parser.error('--plugin-option: unknown plugin %s; see'
+                         ' --list-plugins' % plugin_name)
+
+    # Fields of the connections required by the plugins
+    fields = set()
+    if args.plugins and compute_datagrams:
+        for plugin in plugin_registry.all_plugins():
+            fields.update(plugin.plugin_object.requires)
+    if RTT in fields:
+        fields.update((TIMES, SEQ_ACK))
+    logger.info('Fields to be extracted: %s'
+                % (', '.join(sorted(fields)) if fields else 'none'))
+
+    # Networks of the connections
+    networks = {}
+    for option in ('include_nets', 'exclude_nets'):
+        file_name = getattr(args, option)
+        if file_name is not None:
+            try:
+                networks[option] = load_networks(file_name)
+            except IOError as e:
+                parser.error('--%s: %s' % (option.replace('_', '-'),
+                                           str(e.strerror).lower()))
+            except ValueError as e:
+                parser.error('--%s: %s' % (option.replace('_', '-'), e))
+            logger.info('%d networks read from %s'
+                        % (len(networks[option]), file_name))
+
     # Pcap parser
     logger.info('Pcap parsing...')
     pcap_parser = PcapParser(keep_datagrams=compute_datagrams,
-            tshark_cmd=args.tshark_cmd)
+            tshark_cmd=args.tshark_cmd, fields=fields, **networks)
     # if args.connection_nb is an empty set, ask for all connections
     connection_nb = args.connection_nb if args.connection_nb else None
-    connections = pcap_parser.parse(args.inputFile, connection_nb,
-            args.ssh_only)
+    if not args.sensor_files:
+        connections = pcap_parser.parse(args.inputFile, connection_nb,
+                args.ssh_only)
+    else:
+        # the connections are numbered once the sensors are merged
+        sensors = [Sensor(args.inputFile, pcap_parser.parse(args.inputFile,
+                None, args.ssh_only))]
+        for sensor_file in args.sensor_files:
+            sensor_parser = PcapParser(keep_datagrams=compute_datagrams,
+                    tshark_cmd=args.tshark_cmd, fields=fields, **networks)
+            sensors.append(Sensor(sensor_file, sensor_parser.parse(
+                sensor_file, None, args.ssh_only)))
+        logger.info('Merging the connections of %d sensors' % len(sensors))
+        connections = merge(sensors)
+        if connection_nb:
+            connections = [connection for connection in connections
+                           if connection.nb in connection_nb]
+
+    # Connections active at a date or during a period
+    if args.active_at is not None or args.active_between is not None:
+        time_index = TimeIndex(connections)
+        if args.active_at is not None:
+            connections = time_index.active_at(args.active_at)
+        else:
+            connections = time_index.active_between(*args.active_between)
+        connections.sort(key=lambda connection: connection.nb)
+        logger.info('%d connections active' % len(connections))
 
 
-    # RTT
-    if compute_datagrams:
-        logger.info('RTT computations...')
+    # RTT (computed when the datagrams of a connection are loaded)
+    if RTT in fields:
+        logger.info('RTT computations enabled')
         for connection in connections:
-            connection.compute_rtt()
+            connection.rtt_on_load = True
 
 
     # Printing connections
     logger.info('Printing connections...')
     ConnectionsRepr = ConnectionsNormalRepr
     if args.table:
-        ConnectionsRepr = ConnectionsTableRepr
-    kargs = [logger, compute_datagrams, None if not args.plugins else
-            plugin_manager.getPluginsOfCategory("SingleConnectionAnalyser")]
+        if load_texttable():
+            ConnectionsRepr = ConnectionsTableRepr
+        else:
+            logger.warning('Failed to import texttable')
+    kargs = [logger, compute_datagrams,
+            None if not args.plugins or not compute_datagrams else
+            plugin_registry.plugins_of_category("SingleConnectionAnalyser")]
     if args.csv:
         ConnectionsRepr = ConnectionsCSVRepr
         kargs.append(csv.writer(sys.stdout))
-    connection_repr = ConnectionsRepr(*kargs)
-    for connection in connections:
-        connection_repr.repr(connection)
+    result_cache = None
+    if args.cache_file is not None and args.sensor_files:
+        parser.error('--cache can not be used with --sensor')
+    if args.cache_file is not None and kargs[2]:
+        logger.info('Using the results cache %s' % args.cache_file)
+        try:
+            result_cache = ResultCache(args.cache_file, args.inputFile,
+                    colors=bool(C.FRes))
+        except (OSError, anydbm.error) as e:
+            parser.error('--cache: %s' % str(e).lower())
+    connection_repr = ConnectionsRepr(*kargs, cache=result_cache)
+    # keep the datagrams in memory only if they are used afterwards
+    keep_datagrams = args.plugins and compute_datagrams and any(
+            plugin.plugin_object.requires & DATAGRAMS_FIELDS for plugin in
+            plugin_registry.plugins_of_category("InterConnectionsAnalyser"))
+    # connections are given to the plugins by batches (see analyse_batch)
+    batch_size = connection_repr.batch_size()
+    for i in xrange(0, len(connections), batch_size):
+        batch = connections[i:i + batch_size]
+        connection_repr.prepare(batch)
+        for connection in batch:
+            connection_repr.repr(connection)
+            if not keep_datagrams:
+                connection.release_datagrams()
+    connection_repr.close()
 
 
     # InterConnectionsAnalyser plugins
     if args.plugins and compute_datagrams:
         print
         logger.info('Analyse inter-connections (plugins)')
-        for plugin in plugin_manager.getPluginsOfCategory\
-                ("InterConnectionsAnalyser"):
+        for plugin in plugin_registry.plugins_of_category(
+                "InterConnectionsAnalyser"):
             plugin_object = plugin.plugin_object
             logger.info('Using plugin %s' % plugin.name)
             try:
@@ -23,27 +23,92 @@ Parse the pcap file and outputs Connection instances
 """
 
 
-from connection import Connection, Datagram
-from datetime import datetime
-import logging, subprocess, sys, errno
+from connection import Connection, Datagram, Kexinit, ALL_FIELDS, \
+        DATAGRAMS_FIELDS, KEXINIT, SEQ_ACK, RTT, TIMES
+from datetime import datetime, timedelta
+from functools import partial
+import logging, subprocess, sys, errno, unittest
 
 class PcapParser:
     """Parser for pcap files"""
 
-    def __init__(self, keep_datagrams=True, tshark_cmd='tshark'):
+    # tshark fields needed for the streams
+    STREAMS_FIELDS = [
+            "tcp.stream",
+            "frame.time",
+            "ip.src",
+            "ipv6.src",
+            "tcp.srcport",
+            "ip.dst",
+            "ipv6.dst",
+            "tcp.dstport",
+            "ssh.protocol",
+            "ssh.message_code",
+            "frame.time_relative",
+            ]
+    # tshark fields needed for the datagrams
+    DATAGRAMS_FIELDS = [
+            "tcp.stream",
+            "frame.time",
+            "ip.src",
+            "ipv6.src",
+            "tcp.srcport",
+            "tcp.len",
+            "frame.len",
+            ]
+    SEQ_ACK_FIELDS = [
+            "tcp.seq",
+            "tcp.ack",
+            ]
+    KEXINIT_FIELDS = [
+            "ssh.kex_algorithms",
+            "ssh.server_host_key_algorithms",
+            "ssh.encryption_algorithms_client_to_server",
+            "ssh.encryption_algorithms_server_to_client",
+            "ssh.mac_algorithms_client_to_server",
+            "ssh.mac_algorithms_server_to_client",
+            "ssh.compression_algorithms_client_to_server",
+            "ssh.compression_algorithms_server_to_client",
+            ]
+    # units of the bytes in the statistics of the conversations
+    BYTES_UNITS = {"bytes": 1, "kB": 10 ** 3, "MB": 10 ** 6, "GB": 10 ** 9,
+                   "TB": 10 ** 12}
+
+    def __init__(self, keep_datagrams=True, tshark_cmd='tshark',
+                 fields=ALL_FIELDS, include_nets=None, exclude_nets=None):
         self.keep_datagrams = keep_datagrams # Boolean
         self.tshark_cmd = tshark_cmd
+        # networks (PrefixTree instances, or None) of which the client or the
+        # server must be, and must not be
+        self.include_nets = include_nets
+        self.exclude_nets = exclude_nets
+        self.rejected_streams = set()
+        # fields of the connections to extract (see connection.py)
+        self.fields = frozenset(fields)
         self.logger = logging.getLogger("PcapParser")
         self.streams = []
+        self.ports = set()
+        # statistics of the tcp conversations: (ip, port) of both ends as key
+        # and (frames_b_to_a, bytes_b_to_a, frames_a_to_b, bytes_a_to_b,
+        # end time relative to the capture start) as value, or None if
+        # ambiguous
+        self.conversations = {}
+        # index of the datagrams of each stream, as tuples
+        # (sent_by_client, time, seq_nb, total_len, payload_len, ack)
+        # of unconverted fields; Datagram instances are built on demand
         self.datagrams = {}
+        self.sent_stats = {}
         self.clients = {}
         self.servers = {}
         self.clients_protocol = {}
         self.servers_protocol = {}
         self.clients_algos = {}
         self.servers_algos = {}
+        self.banners = {} # raw banner: decoded and interned banner
+        self.kexinits = {} # raw name-lists: shared Kexinit instance
         self.ssh_streams = {}
         self.start_time = {}
+        self.start_relative = {} # start time relative to the capture start
         self.end_time = {}
         self.file_name = ""
         self.only_ssh = True
@@ -55,30 +120,53 @@ class PcapParser:
         self.logger.info("Start to parse %s", file_name)
         self.file_name = file_name
         self.only_ssh = only_ssh
+        # the statistics of the datagrams are needed for the connections
+        need_stats = self.keep_datagrams
+        if not self.fields & DATAGRAMS_FIELDS:
+            # nothing to index
+            self.keep_datagrams = False
 
         ports = self.extract_ports()
+        self.ports = ports
 
         # get infos about the streams
         self.extract_streams(ports)
 
         # Select only needed tcp streams
         if connections_nb:
-            streams_selected = [self.streams[j-1] for j in connections_nb
-                                if j-1 in range(len(self.streams))]
+            streams_selected = set(self.streams[j-1] for j in connections_nb
+                                   if 0 < j <= len(self.streams))
         else:
-            streams_selected = self.streams
+            streams_selected = set(self.streams)
 
         if self.keep_datagrams:
             self.extract_datagrams(ports, streams_selected)
+        elif need_stats:
+            # the streams unknown by the statistics of the conversations are
+            # indexed together, in a single pass over the capture
+            missing = [k for k in self.streams if k in streams_selected
+                       and self.conversation_stats(k, None)[0] is None]
+            if missing:
+                self.logger.info("No statistics for %d streams: extracting"
+                                 " their datagrams", len(missing))
+                self.extract_datagrams(ports, missing)
 
         # Create Connection objects
+        # (their datagrams are loaded only when used)
         connections = []
-        for k in streams_selected:
+        for nb, k in enumerate(self.streams):
+            if k not in streams_selected:
+                continue
+            duration = self.end_time[k] - self.start_time[k]
+            sent_stats = self.sent_stats.get(k)
+            if sent_stats is None:
+                # datagrams not indexed: use the conversation statistics
+                sent_stats, duration = self.conversation_stats(k, duration)
             connections.append(Connection(
-                self.streams.index(k) + 1, # Connection nb
-                self.datagrams[k],
+                nb + 1, # Connection nb
+                None, # Datagrams
                 self.start_time[k],
-                self.end_time[k] - self.start_time[k], # Duration
+                duration,
                 self.clients[k][0], # Client ip
                 self.servers[k][0], # Server ip
                 self.clients[k][1], # Client port
@@ -87,7 +175,9 @@ class PcapParser:
                 self.servers_protocol[k],
                 self.clients_algos[k],
                 self.servers_algos[k],
-                self.ssh_streams[k]))
+                self.ssh_streams[k],
+                partial(self.load_datagrams, k),
+                sent_stats))
             self.logger.debug("New connection (#%d)", connections[-1].nb)
 
         self.logger.info("Parsing %s finished", file_name)
@@ -95,7 +185,11 @@ class PcapParser:
 
 
     def extract_ports(self):
-        """Extract the port numbers of tcp conversations"""
+        """
+        Extract the port numbers of tcp conversations
+
+        The statistics of the conversations are kept in self.conversations
+        """
 
         ports = set()
 
@@ -114,47 +208,75 @@ class PcapParser:
             for line in lines[5:-2]:
                 line = [a for a in line.split(" ") if a]
                 try:
-                    ports.add(int(line[0].split(":")[-1]))
-                    ports.add(int(line[2].split(":")[-1]))
+                    a = line[0].rsplit(":", 1)
+                    b = line[2].rsplit(":", 1)
+                    a = (a[0], int(a[-1]))
+                    b = (b[0], int(b[-1]))
                 except ValueError as e:
                     self._parse_error(e)
+                ports.add(a[1])
+                ports.add(b[1])
+                key = (a, b)
+                if key in self.conversations:
+                    # the same ends are used by several conversations
+                    self.conversations[key] = None
+                else:
+                    self.conversations[key] = self._conversation(line[3:])
 
         return ports
 
-    def _tshark_extract_streams(self, ports):
-        """Extract the streams (and maybe datagrams)"""
-        self._tshark_datagrams = []
-
-        args = [
-            self.tshark_cmd, "-n", "-r", self.file_name,
-            "-Rssh.protocol" if self.only_ssh else "-Rtcp",
-            "-Tfields",
-            "-etcp.stream",
-            "-eframe.time",
-            "-eip.src",
-            "-eipv6.src",
-            "-etcp.srcport",
-            "-eip.dst",
-            "-eipv6.dst",
-            "-etcp.dstport",
-            "-essh.protocol",
-            "-essh.message_code"]
-
-        if not self.only_ssh and self.keep_datagrams:
-            args .extend([
-                "-etcp.seq",
-                "-etcp.len",
-                "-eframe.len",
-                "-etcp.ack",
-                "-essh.kex_algorithms",
-                "-essh.server_host_key_algorithms",
-                "-essh.encryption_algorithms_client_to_server",
-                "-essh.encryption_algorithms_server_to_client",
-                "-essh.mac_algorithms_client_to_server",
-                "-essh.mac_algorithms_server_to_client",
-                "-essh.compression_algorithms_client_to_server",
-                "-essh.compression_algorithms_server_to_client",
-                ])
+    def _conversation(self, columns):
+        """
+        Parse the statistics columns of a conversation
+
+        Returns None if the statistics can not be parsed. The bytes given
+        with a unit (e.g. 12 kB) are rounded by tshark
+        """
+        numbers = []
+        for column in columns:
+            if column in self.BYTES_UNITS:
+                if not numbers:
+                    return None
+                numbers[-1] *= self.BYTES_UNITS[column]
+                continue
+            try:
+                numbers.append(float(column.replace(",", "")))
+            except ValueError:
+                return None
+        if len(numbers) != 8:
+            return None
+        return (int(numbers[0]), int(round(numbers[1])), int(numbers[2]),
+                int(round(numbers[3])), numbers[6] + numbers[7])
+
+    def conversation_stats(self, stream, duration):
+        """
+        Return the sent statistics (see Connection) and duration of a stream
+        computed by tshark for the tcp conversation
+
+        The sent statistics are None and the duration is the one given if the
+        conversation is not known
+        """
+        client = self.clients[stream]
+        server = self.servers[stream]
+        conversation = self.conversations.get((client, server))
+        if conversation is not None:
+            # client is a: client sent a_to_b
+            sent_stats = (conversation[2], conversation[3],
+                          conversation[0], conversation[1])
+        else:
+            conversation = self.conversations.get((server, client))
+            if conversation is None:
+                return None, duration
+            # client is b: client sent b_to_a
+            sent_stats = conversation[:4]
+        return sent_stats, timedelta(seconds=round(
+            conversation[4] - self.start_relative[stream], 6))
+
+    def _tshark(self, display_filter, fields, ports):
+        """Call tshark and yield the requested fields of each datagram"""
+        args = [self.tshark_cmd, "-n", "-r", self.file_name,
+                "-R", display_filter, "-Tfields"]
+        args.extend("-e%s" % field for field in fields)
         for port in ports:
             args.append("-dtcp.port==%d,ssh" % port)
 
@@ -163,19 +285,56 @@ class PcapParser:
                 args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         except OSError as e:
             self._os_error(e)
-        (stdout, stderr) = tshark.communicate()
+        try:
+            (stdout, stderr) = tshark.communicate()
+        finally:
+            if tshark.returncode is None:
+                # interrupted (e.g. by a TimeBudgetExceeded): reap tshark
+                tshark.kill()
+                tshark.wait()
         if tshark.returncode:
             self._tshark_error(tshark.returncode, stderr)
 
         for l in stdout.split("\n"):
             p = l.split("\t")
-            if len(p) < 10:
+            if len(p) < len(fields):
                 continue
             yield p
-            if not self.only_ssh and self.keep_datagrams:
-                self._tshark_datagrams.append([p[0], p[10], p[1], p[11], p[12],
-                    p[13], p[2], p[3], p[4], p[14], p[15], p[16], p[17], p[18],
-                    p[19], p[20], p[21]])
+
+    def _datagrams_fields(self):
+        """tshark fields to get for the datagrams"""
+        fields = list(self.DATAGRAMS_FIELDS)
+        if self.fields & set((SEQ_ACK, RTT)):
+            fields.extend(self.SEQ_ACK_FIELDS)
+        return fields
+
+    def _tshark_extract_streams(self, ports):
+        """Extract the streams (and maybe datagrams)"""
+        self._tshark_datagrams = []
+
+        fields = list(self.STREAMS_FIELDS)
+        if self.only_ssh:
+            display_filter = "ssh.protocol"
+            if KEXINIT in self.fields:
+                display_filter += " or ssh.kex_algorithms"
+        else:
+            display_filter = "tcp"
+        if KEXINIT in self.fields:
+            fields.extend(self.KEXINIT_FIELDS)
+        cache_datagrams = not self.only_ssh and self.keep_datagrams
+        if cache_datagrams:
+            # all the datagrams are read anyway: keep them
+            datagrams_fields = self._datagrams_fields()
+            fields.extend(f for f in datagrams_fields if f not in fields)
+            datagrams_columns = [fields.index(f) for f in datagrams_fields]
+
+        for p in self._tshark(display_filter, fields, ports):
+            yield p
+            # only the datagrams of the streams kept by extract_streams (e.g.
+            # not rejected by the networks)
+            if cache_datagrams and p[0] in self.start_time:
+                self._tshark_datagrams.append([p[i]
+                                               for i in datagrams_columns])
 
     def _tshark_extract_datagrams(self, ports, streams):
         """Extract the datagrams"""
@@ -194,62 +353,32 @@ class PcapParser:
                                                 for stream in streams])
 
             # Read the pcap file to get the packet informations
-            args = [
-                    "tshark", "-n", "-r", self.file_name,
-                    "-R", tshark_stream_string,
-                    "-Tfields",
-                    "-etcp.stream",
-                    "-etcp.seq",
-                    "-eframe.time",
-                    "-etcp.len",
-                    "-eframe.len",
-                    "-etcp.ack",
-                    "-eip.src",
-                    "-eipv6.src",
-                    "-etcp.srcport",
-                    "-essh.kex_algorithms",
-                    "-essh.server_host_key_algorithms",
-                    "-essh.encryption_algorithms_client_to_server",
-                    "-essh.encryption_algorithms_server_to_client",
-                    "-essh.mac_algorithms_client_to_server",
-                    "-essh.mac_algorithms_server_to_client",
-                    "-essh.compression_algorithms_client_to_server",
-                    "-essh.compression_algorithms_server_to_client",
-                    ]
-
-            for port in ports:
-                args.append("-dtcp.port==%d,ssh" % port)
-
-            try:
-                tshark = subprocess.Popen(
-                    args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            except OSError as e:
-                self._os_error(e)
-            (stdout, stderr) = tshark.communicate()
-            if tshark.returncode:
-                self._tshark_error(tshark.returncode, stderr)
-
-            for l in stdout.split("\n"):
-                p = l.split("\t")
-                if len(p) < 17:
-                    continue
+            for p in self._tshark(tshark_stream_string,
+                                  self._datagrams_fields(), ports):
                 yield p
 
     def extract_streams(self, ports):
         """Decode ports as ssh, and get the packets 'ssh.protocol'"""
 
+        kexinit = KEXINIT in self.fields
         for p in self._tshark_extract_streams(ports):
             try:
-                src = (p[2] if p[2] else p[3], int(p[4]))
-                dst = (p[5] if p[5] else p[6], int(p[7]))
-
-                if p[0] not in self.datagrams.keys():
+                if p[0] not in self.start_time:
+                    if p[0] in self.rejected_streams:
+                        continue
+                    if self.only_ssh and not p[8]:
+                        # only a key exchange: not a known ssh connection
+                        continue
+                    if not self.is_selected((p[2] if p[2] else p[3],
+                                             p[5] if p[5] else p[6])):
+                        self.rejected_streams.add(p[0])
+                        continue
                     # This is a new connection
                     self.streams.append(p[0])
-                    self.datagrams[p[0]] = []
                     time = datetime.strptime(
                         p[1][:-3], "%b %d, %Y %H:%M:%S.%f")
                     self.start_time[p[0]] = time
+                    self.start_relative[p[0]] = float(p[10])
                     self.end_time[p[0]] = time
                     self.clients_protocol[p[0]] = None
                     self.servers_protocol[p[0]] = None
@@ -258,15 +387,21 @@ class PcapParser:
                     self.ssh_streams[p[0]] = False
                     # assume the first packet of the connection
                     # is send by the client
-                    self.clients[p[0]] = src
-                    self.servers[p[0]] = dst
+                    self.clients[p[0]] = (p[2] if p[2] else p[3], int(p[4]))
+                    self.servers[p[0]] = (p[5] if p[5] else p[6], int(p[7]))
+
+                src = (p[2] if p[2] else p[3], int(p[4]))
+                dst = (p[5] if p[5] else p[6], int(p[7]))
 
                 # if datagram detected as ssh, the stream is a ssh connection
                 if p[9] or self.only_ssh:
                     self.ssh_streams[p[0]] = True
 
                 # Get protocol name if available
-                protocol = p[8].decode('string-escape')
+                protocol = self.banners.get(p[8])
+                if protocol is None:
+                    protocol = intern(p[8].decode('string-escape'))
+                    self.banners[p[8]] = protocol
                 if protocol:
                     # if first time we see a protocol and we don't know who is
                     # the client/server, set them
@@ -279,50 +414,111 @@ class PcapParser:
                     else:
                         self.servers_protocol[p[0]] = protocol
 
+                # Algos
+                if kexinit and any(p[11:19]):
+                    self.set_algos(p[0], self.clients[p[0]] == src, p[11:19])
+
             except ValueError as e:
                 # catch conversions for int, datetime...
                 self._parse_error(e)
 
+    def is_selected(self, addresses):
+        """Are the addresses of a stream in the selected networks?"""
+        if self.include_nets is not None and not any(
+                address in self.include_nets for address in addresses):
+            return False
+        if self.exclude_nets is not None and any(
+                address in self.exclude_nets for address in addresses):
+            return False
+        return True
+
+    def set_algos(self, stream, sent_by_client, algos):
+        """
+        Set the algorithms of a KEXINIT packet
+
+        The connections with the same algorithms share the same Kexinit
+        """
+        raw_algos = tuple(algos)
+        algos = self.kexinits.get(raw_algos)
+        if algos is None:
+            algos = Kexinit(*(tuple(intern(name)
+                                    for name in name_list.split(','))
+                              for name_list in raw_algos))
+            self.kexinits[raw_algos] = algos
+        if sent_by_client:
+            self.clients_algos[stream] = algos
+        else:
+            self.servers_algos[stream] = algos
 
     def extract_datagrams(self, ports, streams):
-        """Get datagrams from streams"""
+        """
+        Index the datagrams of the streams
+
+        The Datagram instances are created later by load_datagrams, only for
+        the connections using them. The index is only changed once the
+        extraction is complete, so an interrupted extraction leaves nothing
+        half indexed
+        """
+        seq_ack = len(self._datagrams_fields()) > len(self.DATAGRAMS_FIELDS)
+        last_time = {}
+        datagrams = dict((k, []) for k in streams)
+        sent_stats = dict((k, [0, 0, 0, 0]) for k in streams)
         for p in self._tshark_extract_datagrams(ports, streams):
             try:
-                src = (p[6], int(p[8])) if p[6] else (p[7], int(p[8]))
-                time = datetime.strptime(p[2][:-3],
-                                         "%b %d, %Y %H:%M:%S.%f")
-                self.end_time[p[0]] = time # Keep last know time for duration
+                src = (p[2], int(p[4])) if p[2] else (p[3], int(p[4]))
+                sent_by_client = self.clients[p[0]] == src
+                last_time[p[0]] = p[1] # Keep last know time for duration
+
+                # index the datagram
+                datagrams[p[0]].append((sent_by_client, p[1],
+                    p[7] if seq_ack else "0", p[6], p[5],
+                    p[8] if seq_ack else ""))
+                stats = sent_stats[p[0]]
+                way = 0 if sent_by_client else 2
+                stats[way] += 1
+                stats[way + 1] += int(p[6])
+            except ValueError as e:
+                # catch conversions for int, datetime...
+                self._parse_error(e)
+        # streams without any datagram are indexed as well
+        self.datagrams.update(datagrams)
+        self.sent_stats.update((k, tuple(stats))
+                               for k, stats in sent_stats.iteritems())
+        for k in last_time:
+            try:
+                self.end_time[k] = datetime.strptime(last_time[k][:-3],
+                                                     "%b %d, %Y %H:%M:%S.%f")
+            except ValueError as e:
+                self._parse_error(e)
 
-                # create Datagram objects
+    def load_datagrams(self, stream):
+        """
+        Create the Datagram instances of a stream
+
+        The datagrams are taken from the index, or extracted from the pcap
+        file if the stream was not indexed
+        """
+        if stream not in self.datagrams:
+            self.logger.debug("Extracting datagrams of stream %s", stream)
+            self.extract_datagrams(self.ports, [stream])
+        datagrams = []
+        for (sent_by_client, time, seq_nb, total_len, payload_len, ack) \
+                in self.datagrams.get(stream, ()):
+            try:
                 new_datagram = Datagram(
-                    self.clients[p[0]] == src, # sent by client
-                    time,
-                    int(p[1]), # seq number
-                    int(p[4]), # datagram len
-                    int(p[3]), # payload length
-                    int(p[5]) if p[5] else -1 # datagram acked
+                    sent_by_client,
+                    datetime.strptime(time[:-3], "%b %d, %Y %H:%M:%S.%f"),
+                    int(seq_nb),
+                    int(total_len), # datagram len
+                    int(payload_len),
+                    int(ack) if ack else -1 # datagram acked
                     )
-                self.datagrams[p[0]].append(new_datagram)
-                self.logger.debug("New datagram: %s", new_datagram)
-                # Algos
-                if any(p[i] for i in xrange(9, 17)):
-                    algos = {
-                            "kex_algorithms": p[9],
-                            "server_host_key_algorithms": p[10],
-                            "encryption_algorithms_client_to_server": p[11],
-                            "encryption_algorithms_server_to_client": p[12],
-                            "mac_algorithms_client_to_server": p[13],
-                            "mac_algorithms_server_to_client": p[14],
-                            "compression_algorithms_client_to_server": p[15],
-                            "compression_algorithms_server_to_client": p[16],
-                        }
-                    if self.clients[p[0]] == src:
-                        self.clients_algos[p[0]] = algos
-                    else:
-                        self.servers_algos[p[0]] = algos
             except ValueError as e:
                 # catch conversions for int, datetime...
                 self._parse_error(e)
+            datagrams.append(new_datagram)
+            self.logger.debug("New datagram: %s", new_datagram)
+        return datagrams
 
 
     def _os_error(self, e):
@@ -358,6 +554,84 @@ class PcapParser:
         sys.exit(1)
 
 
+class TestPcapParser(unittest.TestCase):
+    """Unit tests for PcapParser"""
+
+    def test_conversation(self):
+        """Statistics of the conversations, with or without units"""
+        parser = PcapParser()
+        self.assertEqual(parser._conversation(
+                "3 250 bytes 4 1,300 bytes 7 1550 bytes 0.5 2.0".split()),
+                (3, 250, 4, 1300, 2.5))
+        self.assertEqual(parser._conversation(
+                "3 12 kB 4 1.5 MB 7 1512 kB 0.5 2.0".split()),
+                (3, 12000, 4, 1500000, 2.5))
+        self.assertIsNone(parser._conversation("3 kB 4".split()))
+        self.assertIsNone(parser._conversation("3 250 4".split()))
+
+    def test_missing_stats(self):
+        """The streams without statistics are extracted in one pass"""
+        parser = PcapParser(fields=())
+        calls = []
+        def tshark(display_filter, fields, ports):
+            calls.append(display_filter)
+            for stream in ('1', '2'):
+                yield [stream, 'May 01, 2012 12:00:05.000000000', '10.0.0.1',
+                       '', '4000' + stream, '10', '76']
+        def extract_streams(ports):
+            for stream in ('0', '1', '2'):
+                parser.streams.append(stream)
+                parser.clients[stream] = ('10.0.0.1', int('4000' + stream))
+                parser.servers[stream] = ('10.0.0.2', 22)
+                parser.start_time[stream] = datetime(2012, 5, 1, 12)
+                parser.end_time[stream] = datetime(2012, 5, 1, 12)
+                parser.start_relative[stream] = 0.
+                for attribute in (parser.clients_protocol,
+                        parser.servers_protocol, parser.clients_algos,
+                        parser.servers_algos, parser.ssh_streams):
+                    attribute[stream] = None
+        parser._tshark = tshark
+        parser.extract_ports = lambda: set((22,))
+        parser.extract_streams = extract_streams
+        parser.conversations[(('10.0.0.1', 40000), ('10.0.0.2', 22))] = \
+                (2, 100, 3, 200, 4.)
+        connections = parser.parse('capture.pcap')
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([connection.sent_stats() for connection
+                          in connections], [(3, 200, 2, 100), (1, 76, 0, 0),
+                                            (1, 76, 0, 0)])
+        self.assertEqual(connections[1].duration, timedelta(seconds=5))
+    def test_interrupted_extraction(self):
+        """An interrupted extraction does not change the index"""
+        parser = PcapParser()
+        def tshark(display_filter, fields, ports):
+            yield ['0', 'May 01, 2012 12:00:05.000000000', '10.0.0.1', '',
+                   '40000', '10', '76', '1', '1']
+            raise KeyboardInterrupt()
+        parser._tshark = tshark
+        parser.clients['0'] = ('10.0.0.1', 40000)
+        self.assertRaises(KeyboardInterrupt, parser.extract_datagrams,
+                          set((22,)), ['0'])
+        self.assertNotIn('0', parser.datagrams)
+        self.assertNotIn('0', parser.sent_stats)
+
+    def test_rejected_streams(self):
+        """The datagrams of the rejected streams are not kept"""
+        from networks import PrefixTree
+        parser = PcapParser(fields=(TIMES,),
+                            exclude_nets=PrefixTree(['10.0.1.0/24']))
+        parser.only_ssh = False
+        def tshark(display_filter, fields, ports):
+            for stream, client in (('0', '10.0.0.1'), ('1', '10.0.1.1'),
+                                   ('0', '10.0.0.1'), ('1', '10.0.1.1')):
+                yield [stream, 'May 01, 2012 12:00:05.000000000', client, '',
+                       '40000', '10.0.0.2', '', '22', '', '', '0.0', '10',
+                       '76']
+        parser._tshark = tshark
+        parser.extract_streams(set((22,)))
+        self.assertEqual(parser.streams, ['0'])
+        self.assertEqual([p[0] for p in parser._tshark_datagrams], ['0', '0'])
+
 if __name__ == '__main__':
     logging.basicConfig(
         format='%(asctime)s    %(levelname)7s    %(name)11s    %(message)s',
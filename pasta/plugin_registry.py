@@ -0,0 +1,403 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Find the plugins (described by their .plugin files) and load them on demand
+
+The informations about the plugins are kept in a manifest file, so that the
+plugins directory is not parsed again as long as its files are unchanged
+"""
+
+
+import os, logging, json, ast, imp, unittest, tempfile, shutil
+from datetime import timedelta
+from ConfigParser import RawConfigParser, Error as ConfigParserError
+
+PLUGINS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'plugins')
+CATEGORIES = ('SingleConnectionAnalyser', 'InterConnectionsAnalyser')
+
+
+def module_available(name):
+    """Can the module be imported (without importing it)?"""
+    try:
+        imp.find_module(name)
+    except ImportError:
+        return False
+    return True
+
+def plugin_key(name):
+    """Normalized name of a plugin (e.g. 'Connection type')"""
+    return name.strip().lower().replace(' ', '_').replace('-', '_')
+
+
+class PluginInfo(object):
+    """A plugin, imported when its plugin_object is first used"""
+
+    def __init__(self, name, module, version, description, category,
+                 class_name, path, default_requires=(), default=True):
+        self.name = name
+        self.module = module # name of the module in the plugins package
+        self.version = version
+        self.description = description
+        self.category = category # one of CATEGORIES
+        self.class_name = class_name # None if not known yet
+        self.path = path # path of the module, without extension
+        # modules without which the plugin is only used when selected
+        self.default_requires = tuple(default_requires)
+        # False if the plugin is only used when selected
+        self.default = default
+        self._plugin_object = None
+
+    def missing_requires(self):
+        """Modules of default_requires which are not available"""
+        return [name for name in self.default_requires
+                if not module_available(name)]
+
+    def keys(self):
+        """Names identifying the plugin (see plugin_key)"""
+        return set((plugin_key(self.name), plugin_key(self.module)))
+
+    @property
+    def plugin_object(self):
+        """Instance of the plugin"""
+        if self._plugin_object is None:
+            logging.getLogger('Plugins').debug('Importing plugin %s'
+                                               % self.name)
+            plugin_class = find_plugin_class(self.module, self.category,
+                                             self.class_name)
+            self._plugin_object = plugin_class()
+        return self._plugin_object
+
+    def set_option(self, name, value):
+        """
+        Change an option of the plugin: an upper case attribute of the plugin
+        class (e.g. TIME_BUDGET), value being a string
+        """
+        name = name.upper()
+        if not hasattr(self.plugin_object, name):
+            raise ValueError('unknown option %s' % name)
+        setattr(self.plugin_object, name,
+                convert_option(getattr(self.plugin_object, name), value))
+
+    def to_dict(self):
+        """Informations to be stored in the manifest"""
+        return {'name': self.name, 'module': self.module,
+                'version': self.version, 'description': self.description,
+                'category': self.category, 'class_name': self.class_name,
+                'path': self.path, 'default_requires': self.default_requires,
+                'default': self.default}
+
+
+def convert_option(current, value):
+    """Convert value (a string) to the type of the current value of an option"""
+    if value.lower() == 'none':
+        return None
+    if isinstance(current, timedelta):
+        return timedelta(seconds=float(value))
+    if isinstance(current, bool):
+        if value.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError('not a boolean: %s' % value)
+        return value.lower() in ('true', '1')
+    if current is None or isinstance(current, (int, float)):
+        # numbers (without known type if the current value is None)
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    if isinstance(current, str):
+        return value
+    if isinstance(current, tuple):
+        # comma separated numbers
+        return tuple(convert_option(None, number.strip())
+                     for number in value.split(',') if number.strip())
+    raise ValueError('option can not be changed')
+
+
+def find_plugin_class(module, category, class_name=None):
+    """Import a plugin module and return its plugin class"""
+    import plugins
+    module = __import__('plugins.%s' % module, fromlist=[module])
+    if class_name is not None:
+        return getattr(module, class_name)
+    base = getattr(plugins, category)
+    for value in vars(module).values():
+        if isinstance(value, type) and issubclass(value, base) \
+                and value is not base:
+            return value
+    raise ImportError('No %s in plugin %s' % (category, module.__name__))
+
+
+class PluginRegistry:
+    """The plugins of a directory"""
+
+    MANIFEST = 'plugins.cache'
+
+    def __init__(self, directory=PLUGINS_DIRECTORY):
+        self.directory = directory
+        self.logger = logging.getLogger('Plugins')
+        self.plugins = []
+        self.locate_plugins()
+
+    def locate_plugins(self):
+        """Find the plugins, from the manifest if it is up to date"""
+        signature = self.signature()
+        manifest = os.path.join(self.directory, self.MANIFEST)
+        try:
+            with open(manifest) as manifest_file:
+                content = json.load(manifest_file)
+            if content['signature'] == signature:
+                self.plugins = [PluginInfo(**plugin)
+                                for plugin in content['plugins']]
+                self.logger.debug('Plugins read from the manifest')
+                return
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        self.logger.info('Plugins directory changed: updating the manifest')
+        self.plugins = []
+        for info_file in sorted(signature):
+            if info_file.endswith('.plugin'):
+                plugin = self.read_plugin_info(info_file)
+                if plugin is not None:
+                    self.plugins.append(plugin)
+        try:
+            with open(manifest, 'w') as manifest_file:
+                json.dump({'signature': signature,
+                           'plugins': [plugin.to_dict()
+                                       for plugin in self.plugins]},
+                          manifest_file)
+        except IOError as e:
+            self.logger.warning('Failed to write the plugins manifest: %s'
+                                % e.strerror)
+
+    def signature(self):
+        """Modification times of the .plugin files and of their modules"""
+        signature = {}
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.plugin') or file_name.endswith('.py'):
+                signature[file_name] = os.path.getmtime(
+                        os.path.join(self.directory, file_name))
+        return signature
+
+    def read_plugin_info(self, info_file):
+        """Read a .plugin file, return a PluginInfo or None"""
+        config = RawConfigParser()
+        try:
+            config.read(os.path.join(self.directory, info_file))
+            name = config.get('Core', 'Name')
+            module = config.get('Core', 'Module')
+            version = config.get('Documentation', 'Version')
+            description = config.get('Documentation', 'Description')
+            default_requires = config.get('Core', 'DefaultRequires') \
+                    if config.has_option('Core', 'DefaultRequires') else ''
+            default = config.getboolean('Core', 'Default') \
+                    if config.has_option('Core', 'Default') else True
+        except (ConfigParserError, ValueError) as e:
+            self.logger.error('Invalid plugin file %s: %s' % (info_file, e))
+            return None
+        path = os.path.join(self.directory, module)
+        category, class_name = self.find_category(path + '.py')
+        if category is None:
+            self.logger.error('No plugin class found for %s' % info_file)
+            return None
+        return PluginInfo(name, module, version, description, category,
+                          class_name, path,
+                          [requirement.strip() for requirement
+                           in default_requires.split(',')
+                           if requirement.strip()], default)
+
+    def find_category(self, module_file):
+        """
+        Find the plugin class in a module, without importing it
+
+        Return (category, class_name), or (None, None) if not found
+        """
+        try:
+            with open(module_file) as source:
+                tree = ast.parse(source.read(), module_file)
+        except (IOError, SyntaxError):
+            return (None, None)
+        for node in tree.body:
+            if isinstance(node, ast.ClassDef):
+                for base in node.bases:
+                    if isinstance(base, ast.Name) and base.id in CATEGORIES:
+                        return (base.id, node.name)
+        return (None, None)
+
+    def select(self, selected=None, excluded=None):
+        """
+        Keep only the plugins in selected (if not None) and not in excluded
+
+        Plugins are identified by their name or module (see plugin_key);
+        return the set of unknown names. Without selection, the plugins not
+        used by default, or whose default_requires modules are missing, are
+        left out
+        """
+        unknown = set(selected or ()) | set(excluded or ())
+        plugins = []
+        for plugin in self.plugins:
+            keys = plugin.keys()
+            unknown -= keys
+            if (selected is None or keys & selected) \
+                    and not keys & (excluded or set()):
+                missing = plugin.missing_requires()
+                if selected is None and not plugin.default:
+                    self.logger.info('Plugin %s not used by default'
+                                     % plugin.name)
+                    continue
+                if selected is None and missing:
+                    self.logger.info('Plugin %s not used by default: %s'
+                            ' missing' % (plugin.name, ', '.join(missing)))
+                    continue
+                plugins.append(plugin)
+        self.plugins = plugins
+        return unknown
+
+    def categories(self):
+        """Names of the categories"""
+        return CATEGORIES
+
+    def plugins_of_category(self, category):
+        """List of the plugins of a category"""
+        return [plugin for plugin in self.plugins
+                if plugin.category == category]
+
+    def all_plugins(self):
+        """List of all the plugins"""
+        return list(self.plugins)
+
+
+class TestPluginRegistry(unittest.TestCase):
+    """Unit tests for PluginRegistry"""
+
+    def setUp(self):
+        """Done before every test"""
+        self.directory = tempfile.mkdtemp()
+        for name in ('bolognese', 'carbonara'):
+            with open(os.path.join(self.directory, name + '.plugin'), 'w') \
+                    as info_file:
+                info_file.write('[Core]\nName = %s sauce\nModule = %s\n'
+                        '[Documentation]\nVersion = 1\nDescription = %s\n'
+                        % (name.capitalize(), name, name))
+        with open(os.path.join(self.directory, 'bolognese.py'), 'w') \
+                as module_file:
+            module_file.write('class Bolognese(SingleConnectionAnalyser):\n'
+                              '    pass\n')
+        with open(os.path.join(self.directory, 'carbonara.py'), 'w') \
+                as module_file:
+            module_file.write('class Carbonara(InterConnectionsAnalyser):\n'
+                              '    pass\n')
+
+    def tearDown(self):
+        """Done after every test"""
+        shutil.rmtree(self.directory)
+
+    def test_locate(self):
+        """Plugins are found without importing them"""
+        registry = PluginRegistry(self.directory)
+        self.assertEqual([p.class_name for p in registry.plugins_of_category(
+            'SingleConnectionAnalyser')], ['Bolognese'])
+        self.assertEqual([p.class_name for p in registry.plugins_of_category(
+            'InterConnectionsAnalyser')], ['Carbonara'])
+
+    def test_manifest(self):
+        """The manifest is used until the directory changes"""
+        PluginRegistry(self.directory)
+        with open(os.path.join(self.directory, PluginRegistry.MANIFEST)) \
+                as manifest_file:
+            content = json.load(manifest_file)
+        content['plugins'][0]['description'] = 'from the manifest'
+        with open(os.path.join(self.directory, PluginRegistry.MANIFEST),
+                  'w') as manifest_file:
+            json.dump(content, manifest_file)
+        registry = PluginRegistry(self.directory)
+        self.assertEqual(registry.plugins[0].description, 'from the manifest')
+        os.remove(os.path.join(self.directory, 'carbonara.plugin'))
+        registry = PluginRegistry(self.directory)
+        self.assertEqual([p.name for p in registry.all_plugins()],
+                         ['Bolognese sauce'])
+        self.assertEqual(registry.plugins[0].description, 'bolognese')
+
+    def test_select(self):
+        """Selection of plugins by name or module"""
+        registry = PluginRegistry(self.directory)
+        self.assertEqual(registry.select(set(('bolognese_sauce', 'pesto'))),
+                         set(('pesto',)))
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['bolognese'])
+        registry = PluginRegistry(self.directory)
+        registry.select(excluded=set(('bolognese',)))
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['carbonara'])
+
+    def test_default_requires(self):
+        """Plugins missing a module are only used when selected"""
+        with open(os.path.join(self.directory, 'carbonara.plugin'), 'a') \
+                as info_file:
+            info_file.write('[Core]\nDefaultRequires = os, no_such_module\n')
+        registry = PluginRegistry(self.directory)
+        self.assertEqual(registry.plugins[1].default_requires,
+                         ('os', 'no_such_module'))
+        self.assertEqual(registry.plugins[1].missing_requires(),
+                         ['no_such_module'])
+        registry.select()
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['bolognese'])
+        registry = PluginRegistry(self.directory)
+        registry.select(set(('carbonara',)))
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['carbonara'])
+
+    def test_default(self):
+        """Plugins not used by default are only used when selected"""
+        with open(os.path.join(self.directory, 'bolognese.plugin'), 'a') \
+                as info_file:
+            info_file.write('[Core]\nDefault = no\n')
+        registry = PluginRegistry(self.directory)
+        self.assertEqual([p.default for p in registry.all_plugins()],
+                         [False, True])
+        registry.select()
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['carbonara'])
+        registry = PluginRegistry(self.directory)
+        registry.select(set(('bolognese',)))
+        self.assertEqual([p.module for p in registry.all_plugins()],
+                         ['bolognese'])
+
+    def test_convert_option(self):
+        """Options are converted to the type of their current value"""
+        self.assertEqual(convert_option(None, '2'), 2)
+        self.assertEqual(convert_option(None, '0.5'), 0.5)
+        self.assertEqual(convert_option(3, 'None'), None)
+        self.assertEqual(convert_option(timedelta(seconds=1), '0.25'),
+                         timedelta(seconds=0.25))
+        self.assertEqual(convert_option('first', 'uniform'), 'uniform')
+        self.assertEqual(convert_option((1, 2), '1, 0.5'), (1, 0.5))
+        self.assertRaises(ValueError, convert_option, 0.5, 'pesto')
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
@@ -24,23 +24,85 @@ Define plugin interraction with PASTA
 The plugins should inherit from a class of this file
 """
 
-from yapsy.IPlugin import IPlugin
+import os, multiprocessing
+from connection import BANNERS, KEXINIT, TIMES, SIZES, SEQ_ACK, RTT, \
+        ALL_FIELDS, SAMPLINGS
 
 
-class SingleConnectionAnalyser(IPlugin):
+# Pairs and function of InterConnectionsAnalyser.map_pairs, inherited by the
+# forked processes
+_pairs = None
+_pair_function = None
+
+def _evaluate_block(block):
+    """Evaluate the pairs of a block (start, stop) in a forked process"""
+    start, stop = block
+    return [_pair_function(first, second)
+            for first, second in _pairs[start:stop]]
+
+
+class SingleConnectionAnalyser(object):
     """Plugin which analyse a single connection"""
 
+    # Fields of the connection used by the plugin (see connection.py):
+    # only the fields required by the plugins are extracted from the capture
+    requires = ALL_FIELDS
+
+    # Budget of the analyse of a connection, None for no limit (these
+    # options can be changed with --plugin-option, see ConnectionsRepr):
+    # maximum duration of the analyse (in seconds), when exceeded the analyse
+    # is interrupted
+    TIME_BUDGET = None
+    # maximum number of datagrams given to the plugin, selected according to
+    # SAMPLING: 'first', 'last' or 'uniform' (see Connection.sample)
+    MAX_DATAGRAMS = None
+    SAMPLING = 'first'
+
+    # Number of connections given at once to analyse_batch: 1 for the plugins
+    # which do not gain anything by analysing several connections at once
+    # (the datagrams of a batch are kept in memory until it is represented)
+    batch_size = 1
+
     def __init__(self):
-        """Do not change this method, use activate instead"""
-        IPlugin.__init__(self)
+        """Do not change this method, use setup instead"""
+        self.is_activated = False
 
     def activate(self):
-        """Activation of the plugin"""
-        IPlugin.activate(self)
+        """
+        Activation of the plugin
+
+        Done once per run, before analysing the first connection
+        """
+        if self.SAMPLING not in SAMPLINGS:
+            raise ValueError('Unknown sampling %s (%s)'
+                             % (self.SAMPLING, ', '.join(SAMPLINGS)))
+        self.setup()
+        self.is_activated = True
 
     def deactivate(self):
-        """Deactivation of the plugin"""
-        IPlugin.deactivate(self)
+        """
+        Deactivation of the plugin
+
+        Done once per run, after analysing the last connection
+        """
+        self.teardown()
+        self.is_activated = False
+
+    def setup(self):
+        """
+        Prepare the analyse of the connections (loggers, tables...)
+
+        Called once per run by activate
+        """
+        pass
+
+    def teardown(self):
+        """
+        Free what has been prepared by setup
+
+        Called once per run by deactivate
+        """
+        pass
 
     def analyse(self, connection):
         """
@@ -52,6 +114,18 @@ class SingleConnectionAnalyser(IPlugin):
         """
         raise NotImplementedError()
 
+    def analyse_batch(self, connections):
+        """
+        Analyse several connections at once (optional)
+
+        Plugins able to analyse many connections faster at once should set
+        batch_size and return a dict with the connections as keys and as values, either the
+        result of result_repr for the connection, or a RuntimeWarning
+        instance if the plugin can not work with this connection.
+        Return None (default) to have the connections analysed one by one.
+        """
+        return None
+
     @staticmethod
     def result_fields():
         """Return the fields of the analyse as a tuple of strings"""
@@ -78,20 +152,76 @@ class SingleConnectionAnalyser(IPlugin):
         raise NotImplementedError()
 
 
-class InterConnectionsAnalyser(IPlugin):
+class InterConnectionsAnalyser(object):
     """Plugin which analyse links between connections"""
 
+    # Fields of the connections used by the plugin (see connection.py):
+    # only the fields required by the plugins are extracted from the capture
+    requires = ALL_FIELDS
+
+    # Number of processes evaluating the pairs of connections (see map_pairs)
+    # and number of pairs given at once to a process
+    JOBS = 1
+    BLOCK_SIZE = 256
+
     def __init__(self):
-        """Do not change this method, use activate instead"""
-        IPlugin.__init__(self)
+        """Do not change this method, use setup instead"""
+        self.is_activated = False
+
+    def map_pairs(self, function, pairs):
+        """
+        Return the list of function(first, second) for the pairs, in order
+
+        With JOBS > 1 the pairs are evaluated by blocks in forked processes,
+        which share the memory of the plugin (read-only: the changes made by
+        function are lost) and send back the results (which must be picklable)
+        """
+        global _pairs, _pair_function
+        pairs = list(pairs)
+        if self.JOBS <= 1 or len(pairs) <= self.BLOCK_SIZE \
+                or not hasattr(os, 'fork'):
+            return [function(first, second) for first, second in pairs]
+        _pairs = pairs
+        _pair_function = function
+        pool = multiprocessing.Pool(self.JOBS)
+        try:
+            blocks = pool.map(_evaluate_block,
+                    [(start, start + self.BLOCK_SIZE)
+                     for start in xrange(0, len(pairs), self.BLOCK_SIZE)],
+                    chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _pairs = None
+            _pair_function = None
+        return [result for block in blocks for result in block]
 
     def activate(self):
         """Activation of the plugin"""
-        IPlugin.activate(self)
+        self.setup()
+        self.is_activated = True
 
     def deactivate(self):
         """Deactivation of the plugin"""
-        IPlugin.deactivate(self)
+        self.teardown()
+        self.is_activated = False
+
+    def setup(self):
+        """
+        Prepare the analyse of the connections
+
+        Called once per run by activate
+        """
+        pass
+
+    def teardown(self):
+        """
+        Free what has been prepared by setup
+
+        Called once per run by deactivate
+        """
+        pass
 
     def analyse(self, connections):
         """
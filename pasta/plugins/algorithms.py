@@ -21,7 +21,10 @@
 """Finds the algorithms (most probably) used"""
 
 
-from plugins import SingleConnectionAnalyser
+import unittest
+from collections import OrderedDict
+from plugins import SingleConnectionAnalyser, KEXINIT
+from connection import Kexinit
 import colors as C
 
 class Algorithms(SingleConnectionAnalyser):
@@ -31,6 +34,8 @@ class Algorithms(SingleConnectionAnalyser):
     Uses: protocol.client_algos, protocol.server_algos
     """
 
+    requires = frozenset((KEXINIT,))
+
     # We need these algorithms to determine best guesses
     # list from \
     #       http://www.iana.org/assignments/ssh-parameters/ssh-parameters.xml
@@ -65,6 +70,30 @@ class Algorithms(SingleConnectionAnalyser):
             'x509v3-ecdsa-sha2-*': (False, True) # FIXME encryption_capable
             }
 
+    # Number of (client_algos, server_algos) pairs whose results are kept
+    CACHE_SIZE = 1024
+
+    def setup(self):
+        """Compile the tables of known algorithms"""
+        # requirements of the kex algorithms: exact names, and prefixes of
+        # the names ending with a *
+        self.kex_exact = dict((algo, cap)
+                for algo, cap in self.KEX_ALGORITHMS.iteritems()
+                if algo[-1] != '*')
+        self.kex_prefixes = [(algo[:-1], cap)
+                for algo, cap in self.KEX_ALGORITHMS.iteritems()
+                if algo[-1] == '*']
+        # capabilities of the server host key algorithms: an algorithm
+        # matches a known one if it has the same name, or if it starts with
+        # the name without its last character (and has no @)
+        self.shk_exact = dict(self.SERVER_HOST_KEY_ALGORITHMS)
+        self.shk_prefixes = [(algo[:-1], cap)
+                for algo, cap in self.SERVER_HOST_KEY_ALGORITHMS.iteritems()]
+        self.shk_caps = {} # algo: capabilities of the matching known algos
+        # results for the ids of (client_algos, server_algos) (which are
+        # shared by the connections), least recently used first
+        self.results = OrderedDict()
+
     def analyse(self, connection):
         """
         Finds the algos most probably used.
@@ -75,6 +104,12 @@ class Algorithms(SingleConnectionAnalyser):
             raise RuntimeWarning("No algos found in connection")
 
         self.connection = connection
+        key = (id(connection.client_algos), id(connection.server_algos))
+        if key in self.results:
+            self.algos = self.results.pop(key)[2]
+            self.results[key] = (connection.client_algos,
+                                 connection.server_algos, self.algos)
+            return
         kex_algo, shk_algo = self.determine_kex_and_server_host_key_algo()
         self.algos = {
                     'kex': kex_algo,
@@ -92,29 +127,31 @@ class Algorithms(SingleConnectionAnalyser):
                     'compression_s2c': self.determine_algo(\
                                     'compression_algorithms_server_to_client'),
                 }
+        # the algos are kept with their results, so that their ids are not
+        # reused by other objects
+        self.results[key] = (connection.client_algos, connection.server_algos,
+                             self.algos)
+        if len(self.results) > self.CACHE_SIZE:
+            self.results.popitem(last=False)
 
     def determine_kex_and_server_host_key_algo(self):
         """Determine the kex_algo and server_host_key_algo"""
-        client_algos = self.connection.client_algos \
-                ['kex_algorithms'].split(',')
-        server_algos = self.connection.server_algos \
-                ['kex_algorithms'].split(',')
+        client_algos = self.connection.client_algos.kex_algorithms
+        server_algos = set(self.connection.server_algos.kex_algorithms)
         for algo in client_algos:
             # check if server supports algo
             if algo not in server_algos:
                 continue
-            # if algo not known, assume requires nothing
-            cap_needed = (False, False)
             # if algo known, find what is required
-            for known_algo in self.KEX_ALGORITHMS:
-                if known_algo[-1] == '*':
-                    if algo.startswith(known_algo[-1]) and '@' not in algo:
-                        cap_needed = self.KEX_ALGORITHMS[known_algo]
-                        break
-                else:
-                    if algo == known_algo:
-                        cap_needed = self.KEX_ALGORITHMS[known_algo]
-                        break
+            # if algo not known, assume requires nothing
+            cap_needed = self.kex_exact.get(algo)
+            if cap_needed is None:
+                cap_needed = (False, False)
+                if '@' not in algo:
+                    for prefix, cap in self.kex_prefixes:
+                        if algo.startswith(prefix):
+                            cap_needed = cap
+                            break
             # check that we can have an algo with required capabilities
             try:
                 shk_algo = self.determine_server_host_key_algo(cap_needed)
@@ -124,36 +161,39 @@ class Algorithms(SingleConnectionAnalyser):
             return (algo, shk_algo)
         return ('unknown', 'unknown')
 
+    def server_host_key_caps(self, algo):
+        """Capabilities of the known algos corresponding to algo"""
+        if algo not in self.shk_caps:
+            caps = set()
+            if algo in self.shk_exact:
+                caps.add(self.shk_exact[algo])
+            if '@' not in algo:
+                caps.update(cap for prefix, cap in self.shk_prefixes
+                            if algo.startswith(prefix))
+            self.shk_caps[algo] = caps
+        return self.shk_caps[algo]
+
     def determine_server_host_key_algo(self, cap_needed):
         """Determine the server_host_key_algo given the nedded capacities"""
-        client_algos = self.connection.client_algos \
-                ['server_host_key_algorithms'].split(',')
-        server_algos = self.connection.server_algos \
-                ['server_host_key_algorithms'].split(',')
+        client_algos = self.connection.client_algos.server_host_key_algorithms
+        server_algos = set(
+                self.connection.server_algos.server_host_key_algorithms)
         for algo in client_algos:
             # check if server supports algo
             if algo not in server_algos:
                 continue
-            # check if algo is known
+            # check if algo is known and has the required capabilities
             # if algo is not known, assume it has not any capabilities
-            for known_algo in self.SERVER_HOST_KEY_ALGORITHMS:
-                cap = self.SERVER_HOST_KEY_ALGORITHMS[known_algo]
-                # check if this algo has the required capabilities
-                if cap_needed[0] and not cap[0]:
-                    continue
-                if cap_needed[1] and not cap[1]:
-                    continue
-                # check if this is the corresponding algo
-                if algo.startswith(known_algo[:-1]) and '@' not in algo:
-                    return algo # algo found!
-                elif algo == known_algo:
+            for cap in self.server_host_key_caps(algo):
+                if (cap[0] or not cap_needed[0]) \
+                        and (cap[1] or not cap_needed[1]):
                     return algo # algo found!
         raise StandardError('No algorithm with required capabilities found')
 
     def determine_algo(self, field):
         """Determines the algorithm of the specified type"""
-        client_algos = self.connection.client_algos[field].split(',')
-        server_algos = self.connection.server_algos[field].split(',')
+        client_algos = getattr(self.connection.client_algos, field)
+        server_algos = set(getattr(self.connection.server_algos, field))
         for algo in client_algos:
             if algo in server_algos:
                 return algo
@@ -214,3 +254,58 @@ class Algorithms(SingleConnectionAnalyser):
                 'Compression algorithm (server to client)': \
                     C.FYel + self.algos['compression_s2c'] + C.FRes
                 }
+
+
+class TestAlgorithms(unittest.TestCase):
+    """Unit tests for Algorithms"""
+
+    class FakeConnection():
+        def __init__(self, client_algos, server_algos):
+            self.client_algos = Kexinit(*(
+                tuple(client_algos.get(field, 'none').split(','))
+                for field in Kexinit._fields))
+            self.server_algos = Kexinit(*(
+                tuple(server_algos.get(field, 'none').split(','))
+                for field in Kexinit._fields))
+
+    def setUp(self):
+        """Done before every test"""
+        self.algorithms = Algorithms()
+        self.algorithms.activate()
+
+    def tearDown(self):
+        """Done after every test"""
+        self.algorithms.deactivate()
+
+    def test_negotiation(self):
+        """The first algorithm of the client supported by the server"""
+        connection = TestAlgorithms.FakeConnection({
+            'kex_algorithms': 'rsa1024-sha1,ecdh-sha2-nistp256',
+            'server_host_key_algorithms':
+                'ssh-rsa-cert-v01@openssh.com,null,ssh-rsa,ssh-dss',
+            'encryption_algorithms_client_to_server': 'aes128-ctr,aes256-ctr'
+            }, {
+            'kex_algorithms': 'ecdh-sha2-nistp256,rsa1024-sha1',
+            'server_host_key_algorithms':
+                'ssh-dss,ssh-rsa,null,ssh-rsa-cert-v01@openssh.com',
+            'encryption_algorithms_client_to_server': 'aes256-ctr'
+            })
+        self.algorithms.analyse(connection)
+        self.assertEqual(self.algorithms.algos['kex'], 'rsa1024-sha1')
+        # rsa1024-sha1 requires a signature capable algorithm
+        self.assertEqual(self.algorithms.algos['server_host_key'], 'ssh-rsa')
+        self.assertEqual(self.algorithms.algos['encryption_c2s'],
+                         'aes256-ctr')
+        self.assertEqual(self.algorithms.algos['encryption_s2c'], 'none')
+
+    def test_cache(self):
+        """The results of the last pairs of algorithms are kept"""
+        self.algorithms.CACHE_SIZE = 2
+        connections = [TestAlgorithms.FakeConnection(
+            {'kex_algorithms': algo, 'server_host_key_algorithms': 'ssh-rsa'},
+            {'kex_algorithms': algo, 'server_host_key_algorithms': 'ssh-rsa'})
+            for algo in ('rsa1024-sha1', 'rsa2048-sha256', 'ecmqv-sha2')]
+        for connection in connections + connections[2:]:
+            self.algorithms.analyse(connection)
+        self.assertEqual(len(self.algorithms.results), 2)
+        self.assertEqual(self.algorithms.algos['kex'], 'ecmqv-sha2')
@@ -23,7 +23,8 @@
 
 import logging, unittest, random
 from datetime import timedelta, datetime
-from plugins import SingleConnectionAnalyser
+from plugins import SingleConnectionAnalyser, TIMES, SIZES
+from connection import DatagramsFeatures, td_us, EPOCH
 
 class ConnectionIdle(SingleConnectionAnalyser):
     """
@@ -32,13 +33,23 @@ class ConnectionIdle(SingleConnectionAnalyser):
     Uses: payload_len, time
     """
 
+    requires = frozenset((TIMES, SIZES))
+
     # Configuration constant
-    time_interval = timedelta(seconds=2)
+    TIME_INTERVAL = timedelta(seconds=2)
+    # lengths of the intervals (in seconds) of the idle profile
+    PROFILE_INTERVALS = (1, 10, 60)
 
-    def activate(self):
-        """Activation of the plugin"""
-        SingleConnectionAnalyser.activate(self)
+    def setup(self):
+        """Prepare the analyse of the connections"""
         self.logger = logging.getLogger('ConnIdle')
+        # checked once, rather than failing on each connection
+        if td_us(self.TIME_INTERVAL) <= 0:
+            raise ValueError('TIME_INTERVAL must be positive')
+        for seconds in self.PROFILE_INTERVALS:
+            if int(round(seconds * 1000000)) <= 0:
+                raise ValueError('PROFILE_INTERVALS must be positive (%g)'
+                                 % seconds)
 
     def analyse(self, connection):
         """
@@ -46,33 +57,42 @@ class ConnectionIdle(SingleConnectionAnalyser):
 
         Simply cuts the duration of the connection in intervals of fixed length
         Idle time is the percentage of intervals with no packets with payload
+
+        The idle time is also computed for each length of PROFILE_INTERVALS
         """
         self.connection = connection
         self.logger.info('Starting computation')
         if not self.connection.duration.total_seconds():
             # connection is empty anyway (avoid division by zero)
             self.logger.warning('Connection is empty')
-            return
-        intervals_total = intervals_idle = 0 # counters
-        position = self.connection.start_time # left limit of the interval
-        for datagram in self.connection.datagrams:
-            if not datagram.payload_len:
-                # idle time at ssh level: ignore packets without payload
-                continue
-            if datagram.time < position:
-                continue # already got one packet in the interval
-            while datagram.time >= position:
-                # this interval is idle, move to the next one
-                intervals_idle += 1
-                intervals_total += 1
-                position += self.time_interval
-            # in fact, the last one was not idle but busy
-            intervals_idle -= 1
-            self.logger.debug('Busy interval: %s - %s' % \
-                    (position, position + self.time_interval))
+            raise RuntimeWarning('Connection is empty')
+        # lengths of the intervals, in microseconds
+        intervals = [td_us(self.TIME_INTERVAL)] + \
+                [int(round(seconds * 1000000))
+                 for seconds in self.PROFILE_INTERVALS]
+        # left limits of the intervals, in microseconds
+        positions = [td_us(self.connection.start_time - EPOCH)] \
+                * len(intervals)
+        intervals_total = [0] * len(intervals) # counters
+        intervals_idle = [0] * len(intervals)
+        # idle time at ssh level: ignore packets without payload
+        for time in self.connection.features.times_us():
+            for i, interval in enumerate(intervals):
+                if time < positions[i]:
+                    continue # already got one packet in the interval
+                # the intervals before the one of this packet are idle
+                nb = (time - positions[i]) / interval + 1
+                intervals_idle[i] += nb - 1
+                intervals_total[i] += nb
+                positions[i] += nb * interval
         self.logger.debug('Idle intervals: %d/%d' % \
-                (intervals_idle, intervals_total))
-        self.idle_time = intervals_idle / float(intervals_total)
+                (intervals_idle[0], intervals_total[0]))
+        if not intervals_total[0]:
+            raise RuntimeWarning('No datagram with payload')
+        self.idle_time = intervals_idle[0] / float(intervals_total[0])
+        self.idle_profile = [(seconds, idle / float(total))
+                for seconds, idle, total in zip(self.PROFILE_INTERVALS,
+                    intervals_idle[1:], intervals_total[1:])]
 
     @staticmethod
     def result_fields():
@@ -80,14 +100,19 @@ class ConnectionIdle(SingleConnectionAnalyser):
         Return the fields of the analyse as a tuple of strings
         (same order as in result_repr)
         """
-        return ('Idle time',)
+        return ('Idle time', 'Idle profile')
 
     def result_repr(self):
         """
         Return the result of the analyse as a tuple of strings
         (same order as in fields_repr)
         """
-        return {'Idle time': '%.1f%%' % (self.idle_time * 100)}
+        result = {'Idle time': '%.1f%%' % (self.idle_time * 100)}
+        if self.idle_profile:
+            result['Idle profile'] = ', '.join('%gs: %.1f%%'
+                    % (seconds, idle_time * 100)
+                    for seconds, idle_time in self.idle_profile)
+        return result
 
 
 class TestConnectionIdle(unittest.TestCase):
@@ -96,6 +121,7 @@ class TestConnectionIdle(unittest.TestCase):
     class FakeDatagram():
         def __init__(self, time):
             self.payload_len = random.choice((0, 32, 42, 1024))
+            self.sent_by_client = random.choice((True, False))
             self.time = time
 
     class FakeConnection():
@@ -104,6 +130,7 @@ class TestConnectionIdle(unittest.TestCase):
             self.duration = timedelta(seconds=random.randint(10, 1000))
             self.start_time = datetime.now()
             self.nb = random.randint(0, 100000)
+            self.features = DatagramsFeatures(self.datagrams)
 
         def fake_random(self):
             """Fake a random connection"""
@@ -129,6 +156,27 @@ class TestConnectionIdle(unittest.TestCase):
         self.assertGreaterEqual(self.connection_idle.idle_time, 0)
         self.assertLessEqual(self.connection_idle.idle_time, 1)
 
+    def test_idle_profile(self):
+        """Longer intervals are less often idle"""
+        self.connection_idle.PROFILE_INTERVALS = (1, 2, 10, 60)
+        self.connection_idle.analyse(self.connection)
+        idle_times = [idle_time for seconds, idle_time
+                      in self.connection_idle.idle_profile]
+        self.assertEqual(idle_times[1], self.connection_idle.idle_time)
+        self.assertEqual(idle_times, sorted(idle_times, reverse=True))
+
+    def test_invalid_intervals(self):
+        """Intervals which are not positive fail at the activation"""
+        self.connection_idle.deactivate()
+        for intervals in ((1, 0), (-10,), (1e-9,)):
+            self.connection_idle.PROFILE_INTERVALS = intervals
+            self.assertRaises(ValueError, self.connection_idle.activate)
+        self.connection_idle.PROFILE_INTERVALS = ()
+        self.connection_idle.TIME_INTERVAL = timedelta(0)
+        self.assertRaises(ValueError, self.connection_idle.activate)
+        self.connection_idle.TIME_INTERVAL = timedelta(seconds=2)
+        self.connection_idle.activate()
+
     # there is not much to test anyway, since the idle time is subjective
 
 
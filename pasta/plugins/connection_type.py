@@ -25,7 +25,9 @@ Finds the type of a connection based on traffic patterns
 
 import logging, unittest, random
 from datetime import datetime, timedelta
-from plugins import SingleConnectionAnalyser
+from itertools import izip
+from plugins import SingleConnectionAnalyser, TIMES, SIZES, RTT
+from connection import DatagramsFeatures, td_us
 
 class ConnectionType(SingleConnectionAnalyser):
     """
@@ -34,23 +36,24 @@ class ConnectionType(SingleConnectionAnalyser):
     Uses: sent_by_client, rtt, payload_len, time
     """
 
+    requires = frozenset((TIMES, SIZES, RTT))
+
     # Configuration constants
 
     # To be part of a shell interaction
-    shell_max_time_to_reply = 0.7 # max nb of RTTs
-    shell_min_replies = 0.6 # min ratio of replies
+    SHELL_MAX_TIME_TO_REPLY = 0.7 # max nb of RTTs
+    SHELL_MIN_REPLIES = 0.6 # min ratio of replies
 
     # To be part of a reverse shell interaction
-    rshell_max_time_to_reply = 0.7 # max nb of RTTs
-    rshell_min_replies = 0.6 # min ratio of replies
+    RSHELL_MAX_TIME_TO_REPLY = 0.7 # max nb of RTTs
+    RSHELL_MIN_REPLIES = 0.6 # min ratio of replies
 
     # To be part of a SCP connection
-    scp_up_min_asymetry = 0.95 # min asymetry if server sent more
-    scp_down_max_asymetry = 0.05 # max asymetry if client sent more
+    SCP_UP_MIN_ASYMETRY = 0.95 # min asymetry if server sent more
+    SCP_DOWN_MAX_ASYMETRY = 0.05 # max asymetry if client sent more
 
-    def activate(self):
-        """Activation of the plugin"""
-        SingleConnectionAnalyser.activate(self)
+    def setup(self):
+        """Prepare the analyse of the connections"""
         self.logger = logging.getLogger('ConnType')
 
     def analyse(self, connection):
@@ -58,7 +61,6 @@ class ConnectionType(SingleConnectionAnalyser):
 
         self.connection = connection
         self.connection_type = None
-        self.time_to_reply = {True: [], False: []}
         self.ratio_server_sent = 0
         self.logger.info('Starting computation')
 
@@ -69,34 +71,31 @@ class ConnectionType(SingleConnectionAnalyser):
             # scp (down)
             self.logger.debug('Asymetry ratio for scp (down): %.2f'
                               ' (min %.2f required)' % (self.ratio_server_sent,
-                                  ConnectionType.scp_up_min_asymetry))
-            if self.ratio_server_sent >= ConnectionType.scp_up_min_asymetry:
+                                  self.SCP_UP_MIN_ASYMETRY))
+            if self.ratio_server_sent >= self.SCP_UP_MIN_ASYMETRY:
                 self.connection_type = 'scp (down)'
                 return
         else:
             # scp (up)
             self.logger.debug('Asymetry ratio for scp (up): %.2f'
                               ' (max %.2f required)' % (self.ratio_server_sent,
-                                  ConnectionType.scp_down_max_asymetry))
-            if self.ratio_server_sent <= ConnectionType.scp_down_max_asymetry:
+                                  self.SCP_DOWN_MAX_ASYMETRY))
+            if self.ratio_server_sent <= self.SCP_DOWN_MAX_ASYMETRY:
                 self.connection_type = 'scp (up)'
                 return
 
-        # compute time to reply
+        # compute times to reply (the RTTs are only used here)
         self.compute_time_to_reply()
 
         # shell (True) and reverse shell (False)
         name = {True: 'shell', False: 'reverse shell'}
-        max_time_to_reply = {True: ConnectionType.shell_max_time_to_reply,
-                             False: ConnectionType.rshell_max_time_to_reply}
-        min_replies = {True: ConnectionType.shell_min_replies,
-                       False: ConnectionType.rshell_min_replies}
+        min_replies = {True: self.SHELL_MIN_REPLIES,
+                       False: self.RSHELL_MIN_REPLIES}
         for way in (True, False): # for both shell and reverse shell
-            if len(self.time_to_reply[way]): # is there replies in this way?
+            if self.replies[way]: # is there replies in this way?
                 # consider only the replies below the threshold
-                replies_to_consider = sum(1 for t in self.time_to_reply[way]
-                                          if t <= max_time_to_reply[way])
-                replies_total = len(self.time_to_reply[way])
+                replies_to_consider = self.fast_replies[way]
+                replies_total = self.replies[way]
                 # compute the ratio
                 ratio = float(replies_to_consider) / float(replies_total)
                 self.logger.debug('Replies ratio for %s: %.2f'
@@ -113,10 +112,9 @@ class ConnectionType(SingleConnectionAnalyser):
 
     def compute_asymetry(self):
         """Compute the asymetry of the connection"""
-        client_sent = float(sum(p.payload_len for p in self.connection.datagrams
-                                if p.sent_by_client))
-        server_sent = float(sum(p.payload_len for p in self.connection.datagrams
-                                if not p.sent_by_client))
+        sent = self.connection.features.payload_sums()
+        client_sent = float(sent[True])
+        server_sent = float(sent[False])
         if server_sent == 0.0:
             # be sure not to have a division by zero error
             self.ratio_server_sent = 0.0
@@ -124,25 +122,32 @@ class ConnectionType(SingleConnectionAnalyser):
             self.ratio_server_sent = server_sent / (server_sent + client_sent)
 
     def compute_time_to_reply(self):
-        """Computes the times to reply"""
+        """
+        Count the replies and the replies below the threshold, in a single
+        pass over the datagrams with payload
+        """
+        features = self.connection.features
         # True: time for the server to reply
         # False: time for the client to reply
-        self.time_to_reply = {True: [], False: []}
-        last_datagram = {True: None, False: None}
-        for datagram in self.connection.datagrams:
-            if not datagram.payload_len:
-                # no payload, skip
-                continue
+        # number of replies, and of replies below the threshold
+        self.replies = {True: 0, False: 0}
+        self.fast_replies = {True: 0, False: 0}
+        max_time_to_reply = {True: self.SHELL_MAX_TIME_TO_REPLY,
+                             False: self.RSHELL_MAX_TIME_TO_REPLY}
+        last_datagram = {True: None, False: None} # (time, rtt or None)
+        for datagram, time in izip(features.payload_datagrams(),
+                                   features.times_us()):
             way = not datagram.sent_by_client
-            if last_datagram[way] is not None \
-                    and last_datagram[way].rtt.total_seconds():
+            # no reply to a datagram without RTT (e.g. failed to compute it)
+            if last_datagram[way] is not None and last_datagram[way][1]:
                 # a reply
-                self.time_to_reply[way].append(
-                    (datagram.time - last_datagram[way].time).total_seconds() /
-                    last_datagram[way].rtt.total_seconds()
-                    )
+                self.replies[way] += 1
+                last_time, last_rtt = last_datagram[way]
+                if float(time - last_time) / td_us(last_rtt) \
+                        <= max_time_to_reply[way]:
+                    self.fast_replies[way] += 1
             last_datagram[way] = None
-            last_datagram[not way] = datagram
+            last_datagram[not way] = (time, datagram.rtt)
 
     @staticmethod
     def result_fields():
@@ -176,6 +181,7 @@ class TestConnectionType(unittest.TestCase):
         def __init__(self):
             self.datagrams = []
             self.nb = random.randint(0, 100000)
+            self.features = DatagramsFeatures(self.datagrams)
 
         def fake_shell(self, way):
             """Fake a shell connection"""
@@ -242,6 +248,28 @@ class TestConnectionType(unittest.TestCase):
         self.connection_type.analyse(self.connection)
         self.assertEqual(self.connection_type.connection_type, 'scp (down)')
 
+    def test_options(self):
+        """The thresholds can be changed for a plugin instance"""
+        self.connection.fake_scp(False)
+        self.connection_type.SCP_UP_MIN_ASYMETRY = 1.01
+        self.connection_type.analyse(self.connection)
+        self.assertNotEqual(self.connection_type.connection_type,
+                            'scp (down)')
+
+    def test_no_rtt(self):
+        """Connections without RTTs are classified"""
+        self.connection.fake_scp(True)
+        for datagram in self.connection.datagrams:
+            datagram.rtt = None
+        self.connection_type.analyse(self.connection)
+        self.assertEqual(self.connection_type.connection_type, 'scp (up)')
+        self.connection = TestConnectionType.FakeConnection()
+        self.connection.fake_shell(True)
+        for datagram in self.connection.datagrams:
+            datagram.rtt = None
+        self.connection_type.analyse(self.connection)
+        self.assertEqual(self.connection_type.connection_type, 'tunnel')
+
 
 if __name__ == '__main__':
     import sys
@@ -22,7 +22,7 @@
 
 
 import unittest, random
-from plugins import SingleConnectionAnalyser
+from plugins import SingleConnectionAnalyser, BANNERS
 import colors as C
 
 class ProtocolVersionExchange(SingleConnectionAnalyser):
@@ -32,13 +32,28 @@ class ProtocolVersionExchange(SingleConnectionAnalyser):
     Uses: protocol.client_protocol, protocol.server_protocol
     """
 
+    requires = frozenset((BANNERS,))
+
+    def setup(self):
+        """Prepare the analyse of the connections"""
+        # separated protocols, the banners being shared by the connections
+        self.protocols = {}
+
+    def teardown(self):
+        """Free what has been prepared by setup"""
+        self.protocols = {}
+
     def analyse(self, connection):
         """Find the protocols anounced"""
         if connection.client_protocol is None \
                 and connection.server_protocol is None:
             raise RuntimeWarning("No protocol exchange found in connection")
-        self.client_protocol = self.separate(connection.client_protocol)
-        self.server_protocol = self.separate(connection.server_protocol)
+        for protocol in (connection.client_protocol,
+                         connection.server_protocol):
+            if protocol not in self.protocols:
+                self.protocols[protocol] = self.separate(protocol)
+        self.client_protocol = self.protocols[connection.client_protocol]
+        self.server_protocol = self.protocols[connection.server_protocol]
 
     def separate(self, protocol):
         """Separate the different parts from a protocol field"""
@@ -26,8 +26,11 @@
 # [2] A Real-Time Algorithm to Detect Long Connection Chains of Interactive
 # Terminal Sessions, by Jianhua Yang and Shou-Hsuan Stephen Huang
 
-import logging
-from plugins import SingleConnectionAnalyser
+import logging, unittest
+from collections import deque
+from datetime import datetime, timedelta
+from plugins import SingleConnectionAnalyser, TIMES, SIZES, \
+        SEQ_ACK
 
 class SteppingStoneDetectionClientSide(SingleConnectionAnalyser):
     """
@@ -39,18 +42,36 @@ class SteppingStoneDetectionClientSide(SingleConnectionAnalyser):
     by Jianhua Yang and Shou-Hsuan Stephen Huang
     """
 
-    def activate(self):
-        """Activation of the plugin"""
-        SingleConnectionAnalyser.activate(self)
+    requires = frozenset((TIMES, SIZES, SEQ_ACK))
+
+    # maximum time between two "Send" packets of the same queue (seconds)
+    TG_THRESHOLD = 0.5
+    # number of RTTs ignored at the beginning of the connection (noise)
+    NOISE = 20
+    # number of RTTs of the mean used to clean a RTT (odd)
+    CLEAN_WIDTH = 5
+    # number of RTTs on each side of a jump
+    JUMP_WIDTH = 3
+
+    def setup(self):
+        """Prepare the analyse of the connections"""
         self.logger = logging.getLogger('SSDClientS')
         self.hosts_number = 0
+        if self.CLEAN_WIDTH < 1 or self.CLEAN_WIDTH % 2 == 0:
+            raise ValueError('CLEAN_WIDTH must be odd and positive')
+        if self.JUMP_WIDTH < 1:
+            raise ValueError('JUMP_WIDTH must be positive')
+        if self.NOISE < 0:
+            raise ValueError('NOISE must not be negative')
 
     def analyse(self, connection):
         """Do all the computations"""
         self.logger.debug('Starting analyse #%d' % (connection.nb))
-        (time, rtt) = self.compute_matching(connection)
-        averaged = self.clean(rtt)
-        self.hosts_number = self.count_jumps(averaged)
+        detector = ChainDetector(self.TG_THRESHOLD, self.NOISE,
+                                 self.CLEAN_WIDTH, self.JUMP_WIDTH)
+        for datagram in connection.features.payload_datagrams():
+            detector.add(datagram)
+        self.hosts_number = detector.max_jumps
 
     @staticmethod
     def result_fields():
@@ -66,91 +87,194 @@ class SteppingStoneDetectionClientSide(SingleConnectionAnalyser):
             'no stepping-stone detected' if self.hosts_number == 1
                 else 'chain of %d stepping-stone(s)' % (self.hosts_number-1)}
 
-    def compute_matching(self, connection):
-        """Match the right packets to get RTT
+
+class SlidingExtrema:
+    """Minimum and maximum of the last width values (monotonic deques)"""
+
+    def __init__(self, width):
+        self.width = width
+        self.nb = 0 # number of values pushed
+        self.mins = deque() # (index, value), increasing values
+        self.maxs = deque() # (index, value), decreasing values
+
+    def push(self, value):
+        """Add a value, forget the one pushed width values ago"""
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((self.nb, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((self.nb, value))
+        self.nb += 1
+        if self.mins[0][0] < self.nb - self.width:
+            self.mins.popleft()
+        if self.maxs[0][0] < self.nb - self.width:
+            self.maxs.popleft()
+
+    minimum = property(lambda self: self.mins[0][1])
+    maximum = property(lambda self: self.maxs[0][1])
+
+
+class ChainDetector:
+    """
+    Count the hosts of a connection chain from the datagrams of the
+    connection given one by one (e.g. from a live capture): each datagram is
+    handled in constant time
+    """
+
+    def __init__(self, tg_threshold=0.5, noise=20, clean_width=5,
+                 jump_width=3):
+        self.tg_threshold = tg_threshold
+        self.noise = noise
+        self.clean_width = clean_width
+        self.jump_width = jump_width
+        # matching of the packets
+        self.previous_send = None
+        self.send_queue = deque()
+        # last RTTs, to clean them
+        self.rtts = deque(maxlen=clean_width)
+        self.nb_rtts = 0
+        # last cleaned RTTs, to count the jumps
+        self.cleaned = deque(maxlen=jump_width + 2)
+        self.nb_cleaned = 0
+        self.left = SlidingExtrema(jump_width)
+        self.right = SlidingExtrema(jump_width)
+        self.next_check = 2 * jump_width - 1
+        self.jumps = 1
+        self.max_jumps = 1 # number of hosts in the chain
+
+    def add(self, p):
+        """
+        Match the right packets to get RTT
         Based on heuristicalgorithm in [1]
         """
-        tg_threshold = 0.5
-        previousSendPacket = None
-        sendQ = []
-        rtt = []
-        time = []
-        time0 = None
-
-        for p in connection.datagrams:
-            if not time0:
-                time0 = p.time
-            if p.sent_by_client and p.payload_len > 0:
-                # This is a "Send" packet
-                if previousSendPacket and \
-                        (p.time - previousSendPacket.time).total_seconds() > \
-                            tg_threshold:
-                    # Reset the queue
-                    sendQ = []
-                else:
-                    sendQ.append(p)
-                previousSendPacket = p
-            elif not p.sent_by_client and p.payload_len > 0:
-                # This is a "Echo" packet sent by the last server in chain
-                q = sendQ.pop(0) if len(sendQ) else None
-                if q and q.ack <= p.seq_nb and q.seq_nb < p.ack:
-                    # Packets p and q are matched
-                    if (p.time - q.time).total_seconds() < 1:
-                        rtt.append((p.time - q.time).total_seconds() * 2)
-                        time.append((p.time - time0).total_seconds())
-
-        return (time, rtt)
-
-    def clean(self, curve):
-        result = []
-        # Get rid of the 10 first packets (noise)
-        i = 10
-        for i in range(20, len(curve) - 2):
-            mean = sum(curve[i-2:i+3])/5
-            if abs(curve[i] - mean) * 100 < 5*curve[i]:
-                result.append(curve[i])
-
-        return result
-
-    def count_jumps(self, rtt):
+        if not p.payload_len:
+            return
+        if p.sent_by_client:
+            # This is a "Send" packet
+            if self.previous_send and \
+                    (p.time - self.previous_send.time).total_seconds() > \
+                        self.tg_threshold:
+                # Reset the queue
+                self.send_queue.clear()
+            else:
+                self.send_queue.append(p)
+            self.previous_send = p
+        else:
+            # This is a "Echo" packet sent by the last server in chain
+            q = self.send_queue.popleft() if self.send_queue else None
+            if q and q.ack <= p.seq_nb and q.seq_nb < p.ack:
+                # Packets p and q are matched
+                if (p.time - q.time).total_seconds() < 1:
+                    self.add_rtt((p.time - q.time).total_seconds() * 2)
+
+    def add_rtt(self, rtt):
+        """
+        Clean the RTTs: keep the ones close to the mean of the RTTs around
+        them, after the noise of the first ones (and once the window of the
+        mean is full, whatever the noise)
+        """
+        self.rtts.append(rtt)
+        self.nb_rtts += 1
+        center = self.nb_rtts - 1 - self.clean_width / 2
+        if center >= self.noise and self.nb_rtts >= self.clean_width:
+            rtt = self.rtts[self.clean_width / 2]
+            mean = sum(self.rtts) / self.clean_width
+            if abs(rtt - mean) * 100 < 5 * rtt:
+                self.add_cleaned(rtt)
+
+    def add_cleaned(self, rtt):
         """
         Count jumps in roundtrip time, representing the number of hosts in the
         connection chain.
         Based on algorithm 2 in [2]
         """
+        self.cleaned.append(rtt)
+        self.nb_cleaned += 1
+        # a jump is checked at i once the next RTT is known
+        i = self.nb_cleaned - 2
+        if i < 0:
+            return
+        self.right.push(self.cleaned[-2])
+        if i >= self.jump_width:
+            self.left.push(self.cleaned[-2 - self.jump_width])
+        if i < self.next_check:
+            return
+        self.next_check = i + 1
+        min_left, max_left = self.left.minimum, self.left.maximum
+        min_right, max_right = self.right.minimum, self.right.maximum
+        if (min_left - max_right) * 100 > 20 * max_right and self.jumps > 1:
+            self.jumps -= 1
+            self.next_check += 2 * self.jump_width - 1
+        elif (min_right - max_left) * 100 > 20 * max_left:
+            self.jumps += 1
+            self.next_check += 2 * self.jump_width - 1
+            if self.jumps > self.max_jumps:
+                self.max_jumps = self.jumps
 
-        jumps = 1
-        max_jumps = 1
-
-        if len(rtt) < 6:
-            return jumps
-
-        i = 5
-        while i < len(rtt)-1:
-            minLeft = min([rtt[i-5], rtt[i-4], rtt[i-3]])
-            maxLeft = max([rtt[i-5], rtt[i-4], rtt[i-3]])
-            minRight = min([rtt[i-2], rtt[i-1], rtt[i]])
-            maxRight = max([rtt[i-2], rtt[i-1], rtt[i]])
-            diff = minLeft - minRight
-            if (minLeft - maxRight) * 100 > 20*maxRight and jumps > 1:
-                jumps -= 1
-                i += 5
-            elif (minRight - maxLeft) * 100 > 20*maxLeft:
-                jumps += 1
-                i += 5
-                if jumps > max_jumps:
-                    max_jumps = jumps
-            i += 1
-        return max_jumps
-                
-    def compute_threshold(self, rtt):
-        number = 0
-        total = 0
-        for i in range(1,len(rtt)):
-            if rtt[1] - rtt[1-1] > 0:
-                total += (rtt[1] - rtt[1-1])
-                number += 1
-        if number == 0:
-            return 0
-        else:
-            return total/number
+
+class TestChainDetector(unittest.TestCase):
+    """Unit tests for ChainDetector"""
+
+    class FakeDatagram():
+        def __init__(self, sent_by_client, time, seq_nb, ack):
+            self.sent_by_client = sent_by_client
+            self.payload_len = 48
+            self.time = time
+            self.seq_nb = seq_nb
+            self.ack = ack
+
+    def test_chain(self):
+        """The RTT increases when the session goes through another host"""
+        detector = ChainDetector()
+        time = datetime(2012, 5, 1)
+        for i in xrange(200):
+            rtt = timedelta(seconds=0.05 if i < 100 else 0.2)
+            detector.add(TestChainDetector.FakeDatagram(True, time, i, i))
+            detector.add(TestChainDetector.FakeDatagram(False, time + rtt / 2,
+                                                        i, i + 1))
+            time += timedelta(seconds=0.3)
+        self.assertEqual(detector.max_jumps, 2)
+
+    def test_clean(self):
+        """The RTTs are cleaned on full windows, even with a small noise"""
+        rtts = [0.1, 0.1, 0.5, 0.1, 0.1, 0.1, 0.1, 0.1, 0.2, 0.1]
+        for noise in (0, 1, 2, 3):
+            detector = ChainDetector(noise=noise)
+            cleaned = []
+            detector.add_cleaned = cleaned.append
+            for rtt in rtts:
+                detector.add_rtt(rtt)
+            self.assertEqual(cleaned, [rtt for i, rtt in enumerate(rtts)
+                                       if max(noise, 2) <= i < len(rtts) - 2
+                                       and abs(rtt - sum(rtts[i - 2:i + 3])
+                                               / 5) * 100 < 5 * rtt])
+
+    def test_options(self):
+        """Invalid windows fail at the activation of the plugin"""
+        plugin = SteppingStoneDetectionClientSide()
+        for name, value in (('CLEAN_WIDTH', 4), ('JUMP_WIDTH', 0),
+                            ('NOISE', -1)):
+            setattr(plugin, name, value)
+            self.assertRaises(ValueError, plugin.activate)
+            delattr(plugin, name)
+        plugin.activate()
+
+    def test_sliding_extrema(self):
+        """Extrema of the last values"""
+        extrema = SlidingExtrema(3)
+        for value, minimum, maximum in ((5, 5, 5), (3, 3, 5), (4, 3, 5),
+                (6, 3, 6), (7, 4, 7), (8, 6, 8)):
+            extrema.push(value)
+            self.assertEqual((extrema.minimum, extrema.maximum),
+                             (minimum, maximum))
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
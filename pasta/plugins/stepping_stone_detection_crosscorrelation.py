@@ -0,0 +1,296 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Detection of stepping stones by cross-correlation of the activity of the
+connections
+
+The payload datagrams of two overlapping connections are counted in bins of
+time, over their overlap; the cross-correlation of these series is computed
+with FFTs for all the delays up to MAX_LAG, and a peak of correlation links
+the connections.
+
+Comparing the couples costs up to MAX_OVERLAP / BIN bins of FFTs each (and
+much more without numpy, the FFTs being then computed in pure Python): the
+plugin is only used when selected with --plugins.
+"""
+
+
+import unittest, cmath, random
+from datetime import datetime, timedelta
+from itertools import izip
+from bisect import bisect_left
+from plugins import InterConnectionsAnalyser, TIMES, SIZES
+from connection import DatagramsFeatures, td_us
+from time_index import TimeIndex
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def fft(values, inverse=False):
+    """Fast Fourier transform (radix-2: the length must be a power of 2)"""
+    values = [complex(value) for value in values]
+    n = len(values)
+    # bit reversal permutation
+    j = 0
+    for i in xrange(1, n):
+        bit = n >> 1
+        while j & bit:
+            j ^= bit
+            bit >>= 1
+        j |= bit
+        if i < j:
+            values[i], values[j] = values[j], values[i]
+    # butterflies
+    sign = 1 if inverse else -1
+    size = 2
+    while size <= n:
+        half = size // 2
+        twiddles = [cmath.exp(sign * 2j * cmath.pi * k / size)
+                    for k in xrange(half)]
+        for start in xrange(0, n, size):
+            for k, twiddle in enumerate(twiddles):
+                a = values[start + k]
+                b = values[start + k + half] * twiddle
+                values[start + k] = a + b
+                values[start + k + half] = a - b
+        size *= 2
+    if inverse:
+        return [value / n for value in values]
+    return values
+
+def cross_correlation(x, y, max_lag):
+    """
+    Cross-correlation of two series of the same length: list of the sums of
+    x[t] * y[t + lag] for lag from -max_lag to max_lag
+    """
+    # padding, so that the lags up to max_lag do not wrap around
+    n = 1
+    while n < len(x) + max_lag:
+        n *= 2
+    if numpy is not None:
+        products = numpy.fft.irfft(numpy.conj(numpy.fft.rfft(x, n))
+                                   * numpy.fft.rfft(y, n), n).tolist()
+    else:
+        padding = [0] * (n - len(x))
+        products = [product.real for product in
+                    fft([a.conjugate() * b for a, b in izip(
+                        fft(list(x) + padding), fft(list(y) + padding))],
+                        inverse=True)]
+    return products[n - max_lag:] + products[:max_lag + 1]
+
+
+class SteppingStoneDetectionCrossCorrelation(InterConnectionsAnalyser):
+    """
+    Detection of stepping stones by cross-correlation of the activity of the
+    connections: the activity of a relayed connection follows the activity
+    of the other one, after a delay
+    """
+
+    requires = frozenset((TIMES, SIZES))
+
+    # Width of the bins counting the payload datagrams
+    BIN = timedelta(seconds=0.1)
+    # Maximum delay between the connections
+    MAX_LAG = timedelta(seconds=5)
+    # Connections compared: at least MIN_DATAGRAMS payload datagrams, and
+    # overlapping at least MIN_OVERLAP
+    MIN_DATAGRAMS = 20
+    MIN_OVERLAP = timedelta(seconds=10)
+    # Only the beginning of longer overlaps is compared, so that the length of
+    # the series does not depend on the lifetime of the connections
+    MAX_OVERLAP = timedelta(hours=1)
+    # Minimum correlation (between -1 and 1) of a link
+    THRESHOLD = 0.6
+
+    def analyse(self, connections):
+        """Analyse the connections"""
+        self.connections = connections
+        self.bins = {} # connection: sorted bins of its payload datagrams
+        self.matches = [] # (connection, connection, lag, correlation)
+        for connection in self.connections:
+            self.compute_bins(connection)
+        couples = self.overlapping_couples()
+        results = self.map_pairs(self.correlate, couples)
+        for (c1, c2), (lag, correlation) in izip(couples, results):
+            if correlation >= self.THRESHOLD:
+                self.matches.append((c1, c2, lag, correlation))
+        if not self.matches:
+            raise RuntimeWarning("No match found")
+
+    def compute_bins(self, connection):
+        """
+        Bin (counted from EPOCH) of each payload datagram: the series are
+        only built over the overlaps, see series
+        """
+        if not connection.datagrams:
+            return
+        times = connection.features.times_us()
+        if len(times) < self.MIN_DATAGRAMS:
+            return
+        width = td_us(self.BIN)
+        self.bins[connection] = [time // width for time in times]
+
+    def series(self, bins, start, end):
+        """Number of payload datagrams in each bin from start to end"""
+        counts = [0] * (end - start)
+        for i in xrange(bisect_left(bins, start), bisect_left(bins, end)):
+            counts[bins[i] - start] += 1
+        return counts
+
+    def overlapping_couples(self):
+        """Couples of connections with bins overlapping at least MIN_OVERLAP"""
+        overlap = td_us(self.MIN_OVERLAP) // td_us(self.BIN)
+        position = dict((c, i) for i, c in enumerate(self.connections))
+        # the payload datagrams are sent while the connections are active
+        time_index = TimeIndex(self.bins)
+        couples = []
+        for c1 in self.bins:
+            bins1 = self.bins[c1]
+            for c2 in time_index.active_between(c1.start_time,
+                                                c1.start_time + c1.duration):
+                if position[c2] <= position[c1]:
+                    continue
+                bins2 = self.bins[c2]
+                if min(bins1[-1], bins2[-1]) + 1 \
+                        - max(bins1[0], bins2[0]) >= overlap:
+                    couples.append((c1, c2))
+        return sorted(couples, key=lambda (c1, c2): (position[c1],
+                                                      position[c2]))
+
+    def correlate(self, c1, c2):
+        """
+        Lag (in seconds, positive if c2 follows c1) and correlation of the
+        peak of cross-correlation of two connections, on (the beginning of)
+        their overlap
+        """
+        bins1 = self.bins[c1]
+        bins2 = self.bins[c2]
+        start = max(bins1[0], bins2[0])
+        end = min(bins1[-1], bins2[-1]) + 1
+        end = min(end, start + td_us(self.MAX_OVERLAP) // td_us(self.BIN))
+        x = self.series(bins1, start, end)
+        y = self.series(bins2, start, end)
+        # centered series
+        mean_x = float(sum(x)) / len(x)
+        mean_y = float(sum(y)) / len(y)
+        x = [value - mean_x for value in x]
+        y = [value - mean_y for value in y]
+        norm = (sum(value * value for value in x)
+                * sum(value * value for value in y)) ** 0.5
+        if not norm:
+            return (0, 0)
+        max_lag = min(td_us(self.MAX_LAG) // td_us(self.BIN), len(x) - 1)
+        correlations = cross_correlation(x, y, max_lag)
+        peak = max(xrange(len(correlations)), key=correlations.__getitem__)
+        return ((peak - max_lag) * td_us(self.BIN) / 1000000.,
+                correlations[peak] / norm)
+
+    def result_repr(self):
+        """Return the result of the analyse as a string"""
+        s = 'Stepping stone links detected (cross-correlation method):'
+        for c1, c2, lag, correlation in self.matches:
+            s += '\n    %d <-> %d (lag %.2fs, correlation %.2f)' \
+                    % (c1.nb, c2.nb, lag, correlation)
+        return s
+
+
+class TestSteppingStoneDetectionCrossCorrelation(unittest.TestCase):
+    """Unit tests for SteppingStoneDetectionCrossCorrelation"""
+
+    class FakeDatagram(object):
+        def __init__(self, time):
+            self.sent_by_client = True
+            self.payload_len = 48
+            self.time = time
+
+    class FakeConnection(object):
+        def __init__(self, nb, times):
+            self.nb = nb
+            self.datagrams = [
+                    TestSteppingStoneDetectionCrossCorrelation.FakeDatagram(
+                        datetime(2012, 5, 1) + timedelta(seconds=time))
+                    for time in times]
+            self.start_time = self.datagrams[0].time
+            self.duration = self.datagrams[-1].time - self.start_time
+            self.features = DatagramsFeatures(self.datagrams)
+
+    def test_fft(self):
+        """Same cross-correlation as the direct computation"""
+        global numpy
+        x = [random.uniform(-1, 1) for _ in xrange(50)]
+        y = [random.uniform(-1, 1) for _ in xrange(50)]
+        direct = [sum(x[t] * y[t + lag] for t in xrange(50)
+                      if 0 <= t + lag < 50) for lag in xrange(-7, 8)]
+        saved = numpy
+        try:
+            # with and without numpy
+            for numpy in (saved, None):
+                for value, expected in izip(cross_correlation(x, y, 7),
+                                            direct):
+                    self.assertAlmostEqual(value, expected)
+        finally:
+            numpy = saved
+
+    def test_links(self):
+        """A relayed connection is found with its delay"""
+        times = sorted(random.uniform(0, 60) for _ in xrange(300))
+        connections = [
+                self.FakeConnection(1, times),
+                self.FakeConnection(2, sorted(random.uniform(0, 60)
+                                              for _ in xrange(300))),
+                self.FakeConnection(3, [time + 0.8 for time in times])]
+        plugin = SteppingStoneDetectionCrossCorrelation()
+        plugin.analyse(connections)
+        self.assertEqual([(c1.nb, c2.nb, round(lag, 1))
+                          for c1, c2, lag, _ in plugin.matches],
+                         [(1, 3, 0.8)])
+
+    def test_long_overlap(self):
+        """Only the beginning of a long overlap is compared"""
+        times = [i * 0.5 + random.uniform(0, 0.4) for i in xrange(200)]
+        times.append(30 * 86400) # a month later
+        connections = [self.FakeConnection(1, times),
+                       self.FakeConnection(2, [time + 0.8 for time in times])]
+        plugin = SteppingStoneDetectionCrossCorrelation()
+        plugin.MAX_OVERLAP = timedelta(minutes=1)
+        bins = [] # (start, end) of the series built
+        def series(bins1, start, end):
+            bins.append((start, end))
+            return SteppingStoneDetectionCrossCorrelation.series(plugin,
+                    bins1, start, end)
+        plugin.series = series
+        plugin.analyse(connections)
+        self.assertEqual([(c1.nb, c2.nb, round(lag, 1))
+                          for c1, c2, lag, _ in plugin.matches],
+                         [(1, 2, 0.8)])
+        self.assertEqual([end - start for start, end in bins], [600, 600])
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
@@ -0,0 +1,213 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Detection of stepping stones by fingerprints of the keystrokes
+
+The keystrokes sent by the client are turned into tokens (quantised payload
+size and gap since the previous keystroke); the k-grams of tokens are hashed
+and winnowed (Winnowing: Local Algorithms for Document Fingerprinting, by
+Saul Schleimer, Daniel S. Wilkerson and Alex Aiken). Connections relaying the
+same keystrokes share many fingerprints, found with an inverted index.
+"""
+
+
+import unittest, random
+from bisect import bisect_right
+from collections import defaultdict, deque
+from datetime import datetime, timedelta
+from plugins import InterConnectionsAnalyser, TIMES, SIZES
+from connection import DatagramsFeatures, td_us
+
+
+def winnow(hashes, window):
+    """
+    Fingerprints of a sequence of hashes: the minimum of each window of
+    hashes (the rightmost one on ties), as a set
+    """
+    fingerprints = set()
+    minimums = deque() # (position, hash), increasing hashes
+    for position, value in enumerate(hashes):
+        while minimums and minimums[-1][1] >= value:
+            minimums.pop()
+        minimums.append((position, value))
+        if minimums[0][0] <= position - window:
+            minimums.popleft()
+        if position >= window - 1:
+            fingerprints.add(minimums[0][1])
+    if 0 < len(hashes) < window:
+        fingerprints.add(minimums[0][1])
+    return fingerprints
+
+
+class SteppingStoneDetectionFingerprint(InterConnectionsAnalyser):
+    """
+    Detection of stepping stones by fingerprints of the keystrokes: the
+    connections relaying the same keystrokes share their fingerprints
+    """
+
+    requires = frozenset((TIMES, SIZES))
+
+    # Payloads sent by the client up to this size (in bytes) are keystrokes
+    KEYSTROKE_SIZE = 128
+    # Tokens: payload size divided by SIZE_QUANTUM (the ciphers and MACs of
+    # the connections of a relay may differ), gap in one of the GAP_BINS (in
+    # seconds)
+    SIZE_QUANTUM = 32
+    GAP_BINS = (0.05, 0.1, 0.2, 0.4, 0.8, 1.6, 3.2)
+    # Fingerprints: minimum hash of the KGRAM tokens in each WINDOW
+    KGRAM = 8
+    WINDOW = 4
+    # Fingerprints shared by more connections are too common to be used
+    MAX_POSTINGS = 64
+    # Links: at least MIN_SHARED fingerprints are shared, which is at least
+    # SIMILARITY of the fingerprints of the connection having the fewest
+    MIN_SHARED = 5
+    SIMILARITY = 0.5
+
+    def analyse(self, connections):
+        """Analyse the connections"""
+        self.connections = connections
+        self.fingerprints = {}
+        self.shared = {}
+        self.matches = []
+        for connection in self.connections:
+            self.fingerprints[connection] = self.compute_fingerprints(
+                    connection)
+        self.find_shared()
+        for c1, c2 in self.shared_couples:
+            shortest = min(len(self.fingerprints[c1]),
+                           len(self.fingerprints[c2]))
+            if self.shared[c1, c2] >= max(self.MIN_SHARED,
+                                          self.SIMILARITY * shortest):
+                self.matches.append((c1, c2))
+        if not self.matches:
+            raise RuntimeWarning("No match found")
+
+    def tokens(self, connection):
+        """Tokens of the keystrokes of a connection"""
+        if not connection.datagrams:
+            return []
+        gap_bins = [td_us(timedelta(seconds=gap)) for gap in self.GAP_BINS]
+        tokens = []
+        last_time = None
+        times = connection.features.times_us(True)
+        datagrams = connection.features.payload_datagrams(True)
+        for time, datagram in zip(times, datagrams):
+            if datagram.payload_len > self.KEYSTROKE_SIZE:
+                continue
+            if last_time is not None:
+                tokens.append((datagram.payload_len // self.SIZE_QUANTUM,
+                               bisect_right(gap_bins, time - last_time)))
+            last_time = time
+        return tokens
+
+    def compute_fingerprints(self, connection):
+        """Winnowed hashes of the k-grams of tokens of a connection"""
+        tokens = self.tokens(connection)
+        hashes = [hash(tuple(tokens[i:i + self.KGRAM]))
+                  for i in xrange(len(tokens) - self.KGRAM + 1)]
+        return winnow(hashes, self.WINDOW)
+
+    def find_shared(self):
+        """Count the fingerprints shared by the connections (inverted index)"""
+        index = defaultdict(list) # fingerprint: connections
+        for connection in self.connections:
+            for fingerprint in self.fingerprints[connection]:
+                index[fingerprint].append(connection)
+        shared = defaultdict(int)
+        for postings in index.itervalues():
+            if len(postings) > self.MAX_POSTINGS:
+                continue
+            # the postings are in the order of the connections
+            for i, c1 in enumerate(postings):
+                for c2 in postings[i + 1:]:
+                    shared[c1, c2] += 1
+        position = dict((c, i) for i, c in enumerate(self.connections))
+        self.shared = shared
+        self.shared_couples = sorted(shared, key=lambda (c1, c2):
+                                     (position[c1], position[c2]))
+
+    def result_repr(self):
+        """Return the result of the analyse as a string"""
+        s = 'Stepping stone links detected (fingerprint method):'
+        for c1, c2 in self.matches:
+            s += '\n    %d <-> %d (%d shared fingerprints)' \
+                    % (c1.nb, c2.nb, self.shared[c1, c2])
+        return s
+
+
+class TestSteppingStoneDetectionFingerprint(unittest.TestCase):
+    """Unit tests for SteppingStoneDetectionFingerprint"""
+
+    class FakeDatagram(object):
+        def __init__(self, payload_len, time):
+            self.sent_by_client = True
+            self.payload_len = payload_len
+            self.time = time
+
+    class FakeConnection(object):
+        def __init__(self, nb, keystrokes, delay, overhead):
+            """Keystrokes (size, gap in seconds) relayed with a delay"""
+            self.nb = nb
+            time = datetime(2012, 5, 1) + timedelta(seconds=delay)
+            self.datagrams = []
+            for size, gap in keystrokes:
+                time += timedelta(seconds=gap)
+                self.datagrams.append(TestSteppingStoneDetectionFingerprint.
+                        FakeDatagram(size + overhead, time))
+            self.features = DatagramsFeatures(self.datagrams)
+
+    @staticmethod
+    def keystrokes(number):
+        """Random keystrokes"""
+        return [(random.choice((32, 48, 64)), random.uniform(0.05, 2))
+                for _ in xrange(number)]
+
+    def test_winnow(self):
+        """Minimum of each window"""
+        self.assertEqual(winnow([77, 74, 42, 17, 98, 50, 17, 98, 8, 88], 4),
+                         set([17, 8]))
+        self.assertEqual(winnow([5, 3], 4), set([3]))
+        self.assertEqual(winnow([], 4), set())
+
+    def test_links(self):
+        """Connections relaying the same keystrokes are linked"""
+        keystrokes = self.keystrokes(300)
+        connections = [
+                self.FakeConnection(1, keystrokes, 0, 0),
+                self.FakeConnection(2, self.keystrokes(300), 0, 0),
+                self.FakeConnection(3, keystrokes, 0.01, 4),
+                self.FakeConnection(4, self.keystrokes(300), 0, 0)]
+        plugin = SteppingStoneDetectionFingerprint()
+        plugin.analyse(connections)
+        self.assertEqual([(c1.nb, c2.nb) for c1, c2 in plugin.matches],
+                         [(1, 3)])
+        self.assertRaises(RuntimeWarning, plugin.analyse, connections[1::2])
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
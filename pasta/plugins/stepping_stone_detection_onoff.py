@@ -25,8 +25,141 @@ by Yin Zhang and Vern Paxson
 """
 
 
-from plugins import InterConnectionsAnalyser
+import unittest
+from itertools import izip, islice
+from collections import Counter, defaultdict, OrderedDict, deque
+from plugins import InterConnectionsAnalyser, TIMES, SIZES
+from connection import td_us, EPOCH
+from networks import parse_address
 from datetime import timedelta
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def coincidences(off1, off2, delta):
+    """
+    Compare the ends of OFF periods of two connections (sorted lists), as
+    when merging them: return the number of coincidences (ends closer than
+    delta) and the length of the longest run of consecutive coincidences
+
+    The k-th comparison of the merge is made when the k-th element of the
+    merge is reached, between this element and the last reached element of
+    the other list; the merge stops at the last element of either list.
+    Without numpy, the lists are simply merged
+    """
+    if numpy is None or len(off1) == 0 or len(off2) == 0:
+        return merge_coincidences(off1, off2, delta)
+    off1 = numpy.asarray(off1, dtype=numpy.int64)
+    off2 = numpy.asarray(off2, dtype=numpy.int64)
+    # position in the other list of each element (off1 first on ties)
+    positions1 = numpy.searchsorted(off2, off1, side='left')
+    positions2 = numpy.searchsorted(off1, off2, side='right')
+    # number of comparisons
+    steps = min(len(off1) - 1 + positions1[-1],
+                len(off2) - 1 + positions2[-1]) + 1
+    coincident = numpy.zeros(steps, dtype=numpy.int8)
+    for off, other, positions in ((off1, off2, positions1),
+                                  (off2, off1, positions2)):
+        # comparisons made when the elements of off are reached
+        reached = numpy.arange(len(off)) + positions
+        compared = reached < steps
+        close = numpy.abs(off[compared] - other[positions[compared]]) < delta
+        coincident[reached[compared][close]] = 1
+    # runs of coincidences, between a rise and a fall
+    changes = numpy.diff(numpy.concatenate(([0], coincident, [0])))
+    runs = numpy.flatnonzero(changes == -1) - numpy.flatnonzero(changes == 1)
+    return (int(coincident.sum()), int(runs.max()) if len(runs) else 0)
+
+def merge_coincidences(off1, off2, delta):
+    """Same as coincidences, by merging the lists (sorted or not)"""
+    if len(off1) == 0 or len(off2) == 0:
+        return (0, 0)
+    consecutives = []
+    consecutive = 0
+    correlated = 0
+    off1 = iter(off1)
+    off2 = iter(off2)
+    end1 = off1.next()
+    end2 = off2.next()
+    while True:
+        if end1 - end2 < delta and end2 - end1 < delta:
+            consecutive += 1
+            correlated += 1
+        else:
+            consecutives.append(consecutive)
+            consecutive = 0
+        try:
+            if end1 > end2:
+                end2 = off2.next()
+            else:
+                end1 = off1.next()
+        except StopIteration:
+            break
+    consecutives.append(consecutive)
+    return (correlated, max(consecutives))
+
+def bucket_hits(offs, width):
+    """
+    Count, for the pairs of lists of offs (a dict of lists), the elements of
+    the first list having an element of the second list in the same or in a
+    neighbouring bucket of the given width
+
+    This is an upper bound of the number of elements of the first list closer
+    than width to an element of the second list. Return a dict with the pairs
+    of keys as keys, pairs without any hit are not in the dict
+    """
+    buckets = {}
+    index = {} # keys of the lists having an element in each bucket
+    for key, off in offs.iteritems():
+        buckets[key] = Counter(end // width for end in off)
+        for bucket in buckets[key]:
+            index.setdefault(bucket, []).append(key)
+    hits = defaultdict(int)
+    for key in offs:
+        for bucket, number in buckets[key].iteritems():
+            neighbours = set(index.get(bucket - 1, ()))
+            neighbours.update(index[bucket], index.get(bucket + 1, ()))
+            neighbours.discard(key)
+            for other in neighbours:
+                hits[key, other] += number
+    return hits
+
+def network(ip, prefix=None):
+    """
+    Network of an address (IPv4 or IPv6) given its prefix length, the address
+    itself if prefix is None
+    """
+    if prefix is None:
+        return ip
+    try:
+        family, bits, address = parse_address(ip)
+    except ValueError:
+        return ip
+    return (family, address >> max(bits - prefix, 0))
+
+def chains(links):
+    """
+    Group the linked elements (links are couples of elements) with a
+    union-find: return the list of the groups (lists) of linked elements
+    """
+    parent = {}
+    def find(element):
+        root = parent.setdefault(element, element)
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while element != root:
+            parent[element], element = root, parent[element]
+        return root
+    for element1, element2 in links:
+        parent[find(element1)] = find(element2)
+    groups = {}
+    for element in parent:
+        groups.setdefault(find(element), []).append(element)
+    return groups.values()
+
 
 class SteppingStoneDetectionOnOff(InterConnectionsAnalyser):
     """
@@ -35,6 +168,8 @@ class SteppingStoneDetectionOnOff(InterConnectionsAnalyser):
     by Yin Zhang and Vern Paxson
     """
 
+    requires = frozenset((TIMES, SIZES))
+
     # Control parameters (names from the paper), values are choosen from 5.6
     # for the initial computations
     TIDLE = timedelta(seconds = 0.5)
@@ -44,24 +179,25 @@ class SteppingStoneDetectionOnOff(InterConnectionsAnalyser):
     # for the second restriction of matches
     MINCSC = 2
     GAMMAPRIME = 0.02
+    # Compare only the couples of connections which may form a relay: the
+    # server of a connection is the client of the other, or is in the same
+    # network given its prefix length (e.g. 24 for relays behind a NAT)
+    RELAYS_ONLY = False
+    RELAY_PREFIX = None
 
     def analyse(self, connections):
         """Analyse the connections"""
         # Init
         self.connections = connections
         self.off = {}
+        self.off_sorted = {}
         self.correlated = {}
         self.consecutive = {}
         self.matches = [] # list of the possible couples of connections
         # i.e. (i, j) with i < j were i and j are the connection.nb values
-        for c1 in self.connections:
-            iterator = iter(self.connections)
-            while iterator.next() != c1:
-                pass
-            for c2 in iterator:
-                self.matches.append((c1, c2))
         # Initial computations
         self.compute_off()
+        self.find_candidates()
         self.compute_coincidences()
         # First restriction of matches
         self.first_check()
@@ -73,44 +209,90 @@ class SteppingStoneDetectionOnOff(InterConnectionsAnalyser):
 
     def compute_off(self):
         """Find the off periods for each connection"""
+        tidle = td_us(self.TIDLE)
         for connection in self.connections:
             self.off[connection] = []
-            iterator = iter(connection.datagrams)
-            last_time = iterator.next().time
-            for datagram in iterator:
-                if not datagram.payload_len:
-                    continue # consider only datagrams with payload
-                if datagram.time - last_time < self.TIDLE:
-                    self.off[connection].append(datagram.time)
-                last_time = datagram.time
+            self.off_sorted[connection] = True
+            if not connection.datagrams:
+                continue
+            # consider only datagrams with payload (except the first one)
+            times = connection.features.times_us()
+            if connection.features.payload_indices()[:1] == [0]:
+                times = times[1:]
+            last_time = td_us(connection.datagrams[0].time - EPOCH)
+            for time in times:
+                if time - last_time < tidle:
+                    self.off[connection].append(time)
+                last_time = time
+            off = self.off[connection]
+            self.off_sorted[connection] = all(end1 <= end2 for end1, end2
+                                              in izip(off, islice(off, 1, None)))
+
+    def find_candidates(self):
+        """
+        Find the couples of connections which may pass the checks
+
+        A coincidence needs ends of OFF periods in the same or in neighbouring
+        buckets of DELTA width, so the bucket hits bound the number of
+        correlations: the couples whose bound is below the thresholds of the
+        checks are not compared (no false negative). With RELAYS_ONLY, only
+        the couples which may form a relay are considered
+        """
+        position = dict((c, i) for i, c in enumerate(self.connections))
+        hits = bucket_hits(self.off, max(td_us(self.DELTA), 1))
+        # couples without any hit have no coincidence
+        if self.RELAYS_ONLY:
+            couples = [couple for couple in self.relay_couples()
+                       if couple in hits or self.MINCSC <= 0]
+        elif self.MINCSC > 0:
+            couples = hits
+        else:
+            couples = [(c1, c2) for i, c1 in enumerate(self.connections)
+                       for c2 in self.connections[i + 1:]]
+        couples = set((c1, c2) if position[c1] < position[c2] else (c2, c1)
+                      for c1, c2 in couples)
+        for c1, c2 in sorted(couples,
+                             key=lambda (c1, c2): (position[c1], position[c2])):
+            shortest = min(len(self.off[c1]), len(self.off[c2]))
+            if hits.get((c1, c2), 0) + hits.get((c2, c1), 0) >= max(
+                    self.GAMMA * shortest, self.MINCSC,
+                    self.GAMMAPRIME * shortest):
+                self.matches.append((c1, c2))
+
+    def relay_couples(self):
+        """
+        Couples of connections (inbound, outbound) where the server of the
+        inbound connection may be the client of the outbound one (host graph)
+        """
+        outbound = {} # network: connections of which it is the client
+        for connection in self.connections:
+            outbound.setdefault(network(connection.client_ip,
+                    self.RELAY_PREFIX), []).append(connection)
+        for inbound in self.connections:
+            for connection in outbound.get(network(inbound.server_ip,
+                                                   self.RELAY_PREFIX), ()):
+                if connection is not inbound:
+                    yield (inbound, connection)
 
     def compute_coincidences(self):
         """Compute the correlations and number of consecutive coincidences"""
-        for (c1, c2) in self.matches:
-            consecutives = []
-            consecutive = 0
-            correlated = 0
-            off1 = iter(self.off[c1])
-            off2 = iter(self.off[c2])
-            end1 = off1.next()
-            end2 = off2.next()
-            while True:
-                if end1 - end2 < self.DELTA and end2 - end1 < self.DELTA:
-                    consecutive += 1
-                    correlated += 1
-                else:
-                    consecutives.append(consecutive)
-                    consecutive = 0
-                try:
-                    if end1 > end2:
-                        end2 = off2.next()
-                    else:
-                        end1 = off1.next()
-                except StopIteration:
-                    break
-            consecutives.append(consecutive)
+        delta = td_us(self.DELTA)
+        off = {} # sorted ends of OFF periods converted once to arrays
+        for connection, sorted_off in self.off_sorted.iteritems():
+            if numpy is not None and sorted_off:
+                off[connection] = numpy.array(self.off[connection],
+                                              dtype=numpy.int64)
+            else:
+                off[connection] = self.off[connection]
+        def count(c1, c2):
+            if numpy is not None and self.off_sorted[c1] \
+                    and self.off_sorted[c2]:
+                return coincidences(off[c1], off[c2], delta)
+            return merge_coincidences(off[c1], off[c2], delta)
+        results = self.map_pairs(count, self.matches)
+        for (c1, c2), (correlated, consecutive) in izip(self.matches, results):
             self.correlated[c1, c2] = correlated
-            self.consecutive[c1, c2] = max(consecutives)
+            self.consecutive[c1, c2] = consecutive
 
     def first_check(self):
         """4.2 Timing correlation when OFF periods end"""
@@ -137,4 +319,315 @@ class SteppingStoneDetectionOnOff(InterConnectionsAnalyser):
         s = 'Stepping stone links detected (on-off method):'
         for c1, c2 in self.matches:
             s += '\n    %d <-> %d' % (c1.nb, c2.nb)
+        if self.RELAYS_ONLY:
+            s += '\nStepping stone chains:'
+            for chain in sorted((sorted(chain, key=lambda c: (c.start_time,
+                                                              c.nb))
+                                 for chain in chains(self.matches)),
+                                key=lambda chain: chain[0].nb):
+                s += '\n    %s' % ' -> '.join('%d' % c.nb for c in chain)
         return s
+
+
+class OnlineConnection(object):
+    """State of a connection in OnlineOnOffDetector"""
+
+    def __init__(self, order, time):
+        self.order = order # rank of the connection, to order the couples
+        self.last_time = time # time of the last datagram with payload
+        self.last_seen = time # time of the last datagram
+        self.off = 0 # number of OFF period ends
+        self.last_sequence = -1 # sequence number of the last OFF period end
+        self.partners = set() # connections with counters in common
+
+
+class OnlineCouple(object):
+    """Counters of a couple of connections in OnlineOnOffDetector"""
+
+    def __init__(self):
+        self.correlated = 0
+        self.consecutive = 0 # longest run of coincidences
+        self.run = 0 # current run of coincidences
+        self.last_step = -2 # comparison of the last coincidence
+        self.matched = False
+
+
+class OnlineOnOffDetector(object):
+    """
+    On-off detection of stepping stones on a stream of datagrams (e.g. live
+    traffic), with the parameters of a SteppingStoneDetectionOnOff
+
+    The coincidences are counted as when merging the OFF periods (see
+    coincidences), as soon as the OFF periods end: each end is compared with
+    the next end of the other connection. The checks are made with the OFF
+    periods seen so far. Only the connections having a datagram in the last
+    window are kept, with the counters of their couples
+    """
+
+    def __init__(self, window=timedelta(minutes=5),
+                 parameters=SteppingStoneDetectionOnOff):
+        self.window = td_us(window)
+        self.tidle = td_us(parameters.TIDLE)
+        self.delta = td_us(parameters.DELTA)
+        self.gamma = parameters.GAMMA
+        self.mincsc = parameters.MINCSC
+        self.gammaprime = parameters.GAMMAPRIME
+        self.connections = OrderedDict() # by time of their last datagram
+        self.couples = {} # (connection, connection): OnlineCouple
+        # OFF period ends of the last delta: (time, sequence number,
+        # connection, index of the end in the connection)
+        self.recent = deque()
+        self.sequence = 0
+        self.order = 0
+
+    def add(self, connection, time, payload):
+        """
+        Add a datagram (the datagrams are added in time order): connection
+        identifies its connection (any hashable value), time is a datetime
+        and payload tells if the datagram has a payload
+
+        Return the list of the couples of connections matching from now on
+        """
+        time = td_us(time - EPOCH)
+        self.expire(time)
+        state = self.connections.pop(connection, None)
+        if state is None:
+            # the first datagram does not end an OFF period
+            self.connections[connection] = OnlineConnection(self.order, time)
+            self.order += 1
+            return []
+        self.connections[connection] = state
+        state.last_seen = time
+        if not payload:
+            return []
+        if time - state.last_time >= self.tidle:
+            state.last_time = time
+            return []
+        state.last_time = time
+        index = state.off
+        state.off += 1
+        # ends of the other connections waiting to be compared with this one
+        while self.recent and self.recent[0][0] <= time - self.delta:
+            self.recent.popleft()
+        close = OrderedDict() # connection: (first, last) indexes of the ends
+        for end, sequence, other, other_index in self.recent:
+            if sequence > state.last_sequence and other != connection \
+                    and other in self.connections:
+                close[other] = (close.get(other, (other_index,))[0],
+                                other_index)
+        matches = []
+        for other, (first, last) in close.iteritems():
+            # step of the merge when the ends of other are compared
+            if self.count(connection, other, first + index, last + index):
+                matches.append(self.couple(connection, other))
+        self.recent.append((time, self.sequence, connection, index))
+        state.last_sequence = self.sequence
+        self.sequence += 1
+        return matches
+
+    def couple(self, connection1, connection2):
+        """Couple of connections, the oldest first"""
+        if self.connections[connection1].order \
+                < self.connections[connection2].order:
+            return (connection1, connection2)
+        return (connection2, connection1)
+
+    def count(self, connection1, connection2, first_step, last_step):
+        """
+        Count the coincidences of a couple of connections from first_step to
+        last_step, return True if the couple matches for the first time
+        """
+        key = self.couple(connection1, connection2)
+        counters = self.couples.get(key)
+        if counters is None:
+            counters = self.couples[key] = OnlineCouple()
+            self.connections[connection1].partners.add(connection2)
+            self.connections[connection2].partners.add(connection1)
+        number = last_step - first_step + 1
+        if first_step == counters.last_step + 1:
+            counters.run += number
+        else:
+            counters.run = number
+        counters.last_step = last_step
+        counters.correlated += number
+        counters.consecutive = max(counters.consecutive, counters.run)
+        if counters.matched:
+            return False
+        shortest = min(self.connections[connection1].off,
+                       self.connections[connection2].off)
+        counters.matched = counters.correlated >= self.gamma * shortest \
+                and counters.consecutive >= self.mincsc \
+                and counters.consecutive >= self.gammaprime * shortest
+        return counters.matched
+
+    def expire(self, time):
+        """Forget the connections without datagram during the last window"""
+        while self.connections:
+            connection, state = next(self.connections.iteritems())
+            if time - state.last_seen <= self.window:
+                break
+            del self.connections[connection]
+            for other in state.partners:
+                self.connections[other].partners.discard(connection)
+                self.couples.pop((connection, other), None)
+                self.couples.pop((other, connection), None)
+
+
+class TestCoincidences(unittest.TestCase):
+    """Unit tests for coincidences"""
+
+    def test_merge(self):
+        """Same results as when merging the lists"""
+        import random
+        for _ in xrange(200):
+            off1 = sorted(random.sample(xrange(1000), random.randint(0, 50)))
+            off2 = sorted(random.choice((off1, [])) + random.sample(
+                xrange(1000), random.randint(0, 50)))
+            self.assertEqual(coincidences(off1, off2, 3),
+                             merge_coincidences(off1, off2, 3))
+
+    def test_coincidences(self):
+        """Coincidences and longest run of coincidences"""
+        self.assertEqual(coincidences([10, 20, 30, 50], [11, 21, 40, 51], 2),
+                         (3, 1))
+        self.assertEqual(coincidences([10, 11], [10, 11], 2), (3, 3))
+        self.assertEqual(coincidences([10], [], 2), (0, 0))
+
+
+class TestSteppingStoneDetectionOnOff(unittest.TestCase):
+    """Unit tests for SteppingStoneDetectionOnOff"""
+
+    def matches(self, off, candidates, jobs=1):
+        """Matches found for the OFF periods, with or without candidates"""
+        plugin = SteppingStoneDetectionOnOff()
+        plugin.JOBS = jobs
+        plugin.BLOCK_SIZE = 2
+        plugin.connections = sorted(off)
+        plugin.off = off
+        plugin.off_sorted = dict((c, True) for c in off)
+        plugin.correlated = {}
+        plugin.consecutive = {}
+        plugin.matches = []
+        if candidates:
+            plugin.find_candidates()
+        else:
+            plugin.matches = [(c1, c2) for c1 in plugin.connections
+                              for c2 in plugin.connections if c1 < c2]
+        plugin.compute_coincidences()
+        plugin.first_check()
+        plugin.second_check()
+        return plugin.matches
+
+    def test_bucket_hits(self):
+        """Elements with an element of the other list in a close bucket"""
+        hits = bucket_hits({1: [10, 35], 2: [21, 90], 3: [500]}, 10)
+        self.assertEqual(dict(hits), {(1, 2): 2, (2, 1): 1})
+
+    def test_candidates(self):
+        """The candidates do not change the matches"""
+        import random
+        delta = td_us(SteppingStoneDetectionOnOff.DELTA)
+        for _ in xrange(20):
+            off = {}
+            for connection in xrange(8):
+                times = random.sample(xrange(0, 100 * delta, delta // 4), 20)
+                if connection % 2:
+                    # relayed connection
+                    times = [time + random.randint(0, delta // 2)
+                             for time in off[connection - 1]]
+                off[connection] = sorted(times)
+            self.assertEqual(self.matches(off, True),
+                             self.matches(off, False))
+
+    def test_relays(self):
+        """Couples of the host graph, chains of links"""
+        class FakeConnection(object):
+            def __init__(self, nb, client_ip, server_ip):
+                self.nb = nb
+                self.start_time = nb
+                self.client_ip = client_ip
+                self.server_ip = server_ip
+        connections = [FakeConnection(1, '10.0.0.1', '10.0.0.2'),
+                       FakeConnection(2, '10.0.0.2', '10.0.0.3'),
+                       FakeConnection(3, '10.0.1.3', '10.0.0.4'),
+                       FakeConnection(4, '10.0.0.9', '10.0.0.1')]
+        plugin = SteppingStoneDetectionOnOff()
+        plugin.connections = connections
+        self.assertEqual([(c1.nb, c2.nb) for c1, c2 in plugin.relay_couples()],
+                         [(1, 2), (4, 1)])
+        plugin.RELAY_PREFIX = 16
+        self.assertEqual(len(list(plugin.relay_couples())), 12)
+        self.assertEqual(network('10.0.1.3', 23), network('10.0.0.4', 23))
+        self.assertNotEqual(network('10.0.1.3', 24), network('10.0.0.4', 24))
+        self.assertEqual(network('2001:db8::1', 64), network('2001:db8::2', 64))
+        self.assertEqual(sorted(sorted(chain) for chain in
+                                chains([(1, 2), (4, 1), (5, 6), (2, 3)])),
+                         [[1, 2, 3, 4], [5, 6]])
+
+    def test_jobs(self):
+        """Same matches with several processes"""
+        import random
+        delta = td_us(SteppingStoneDetectionOnOff.DELTA)
+        off = {}
+        for connection in xrange(6):
+            off[connection] = sorted(random.sample(xrange(0, 20 * delta,
+                                                          delta // 4), 20))
+        self.assertEqual(self.matches(off, False, jobs=3),
+                         self.matches(off, False))
+
+
+class TestOnlineOnOffDetector(unittest.TestCase):
+    """Unit tests for OnlineOnOffDetector"""
+
+    def datagrams(self, connection, off):
+        """Datagrams of a connection ending OFF periods at the off times"""
+        yield (off[0] - 100, connection, False)
+        for time in off:
+            yield (time, connection, True)
+
+    def test_merge(self):
+        """Same counters as when merging the OFF periods"""
+        import random
+        for _ in xrange(50):
+            off = [sorted(random.sample(xrange(0, 10000000, 1000), 40))
+                   for connection in xrange(3)]
+            off[1] = sorted(set(off[1] + [time + random.randint(1, 9) for
+                                          time in off[0]]))
+            datagrams = sorted(datagram for connection in xrange(3)
+                               for datagram in self.datagrams(connection,
+                                                              off[connection]))
+            detector = OnlineOnOffDetector()
+            detector.delta = 500
+            detector.tidle = 10000000
+            for time, connection, payload in datagrams:
+                detector.add(connection, EPOCH + timedelta(microseconds=time),
+                             payload)
+            for c1, c2 in ((0, 1), (0, 2), (1, 2)):
+                counters = detector.couples.get((c1, c2)) or \
+                        detector.couples.get((c2, c1), OnlineCouple())
+                self.assertEqual((counters.correlated, counters.consecutive),
+                                 merge_coincidences(off[c1], off[c2], 500))
+
+    def test_matches(self):
+        """Matches are found once, state of idle connections is forgotten"""
+        detector = OnlineOnOffDetector(window=timedelta(seconds=10))
+        datagrams = sorted(list(self.datagrams('a', range(0, 400000, 10000)))
+                + list(self.datagrams('b', range(1000, 400000, 10000))))
+        matches = []
+        for time, connection, payload in datagrams:
+            matches.extend(detector.add(connection,
+                    EPOCH + timedelta(microseconds=time), payload))
+        self.assertEqual(matches, [('a', 'b')])
+        detector.add('c', EPOCH + timedelta(seconds=20), False)
+        self.assertEqual(detector.connections.keys(), ['c'])
+        self.assertEqual(detector.couples, {})
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
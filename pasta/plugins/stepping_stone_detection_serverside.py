@@ -25,8 +25,35 @@ Detection of stepping stones at the server side based on the paper
 by Ruei-Min Lin, Yi-Chun Chou, and Kuan-Ta Chen
 It is assumed that Nagle's algorithm is enabled at the client.
 """
-import logging
-from plugins import SingleConnectionAnalyser
+import logging, unittest, random
+from datetime import datetime, timedelta
+from bisect import bisect_left, insort
+from itertools import izip
+from plugins import SingleConnectionAnalyser, TIMES, SIZES, RTT
+from connection import Connection, Datagram, TimeBudgetExceeded, \
+        time_budget
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def count_close(rtts, iats, close_enough):
+    """
+    Number of RTTs (not null) with a relative difference to the IAT at the
+    same position of at most close_enough
+
+    Without numpy, the lists are simply scanned
+    """
+    n = min(len(rtts), len(iats))
+    if numpy is None or not n:
+        return sum(1 for rtt, iat in izip(rtts, iats)
+                   if rtt and abs((rtt - iat) / rtt) <= close_enough)
+    rtts = numpy.fromiter(rtts, dtype=numpy.float64, count=n)
+    iats = numpy.fromiter(iats, dtype=numpy.float64, count=n)
+    rtts, iats = rtts[rtts != 0], iats[rtts != 0]
+    return int((numpy.abs((rtts - iats) / rtts) <= close_enough).sum())
+
 
 class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
 
@@ -37,6 +64,8 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
     It is assumed that Nagle's algorithm is enabled at the client.
     """
 
+    requires = frozenset((TIMES, SIZES, RTT))
+
     IAT_RTT_DIFFERENT = 0.01
     CLOSE_ENOUGH = 0.5
     N_MOD_DIST = 0.98
@@ -44,9 +73,8 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
 
     IN_GROUP = 3
 
-    def activate(self):
-        """Activation of the plugin"""
-        SingleConnectionAnalyser.activate(self)
+    def setup(self):
+        """Prepare the analyse of the connections"""
         self.logger = logging.getLogger('SSDServerS')
 
     def analyse(self, connection):
@@ -57,9 +85,8 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
         if self.connection.datagrams == None:
             raise RuntimeWarning("No datagram in the connection.")
         else:
-            self.datagrams = [datagram for datagram in \
-                              self.connection.datagrams if \
-                              datagram.sent_by_client and datagram.payload_len]
+            self.datagrams = \
+                    self.connection.features.payload_datagrams(True)
 
             self.logger.debug('Starting computation for connect. #%d' \
                                                         % self.connection.nb)
@@ -68,7 +95,7 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
                     self.stepping_stone = self.is_stepping_stone()
                     self.logger.debug('Stepping stone detected: %s' \
                                                 % self.stepping_stone)
-                except:
+                except Exception:
                     raise RuntimeWarning("Missing field in the connection\
                                                     (payload or RTT).")
             else:
@@ -103,11 +130,7 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
         """
         self.logger.debug('Computation of RTT & IAT similarity')
         # creation of the RTTs list.
-        rtts = [datagram.rtt.total_seconds() for datagram in self.datagrams]
-        rtts = rtts[1:]
-        iats = []
-        first = True
-        last_datagram = None
+        rtts = self.connection.features.rtts(True)[1:]
 
         if len(rtts) < 20:
             self.logger.debug('Not enough useful datagrams to do the' \
@@ -116,25 +139,10 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
                                  ' computation')
 
         # creation of the IATs list.
-        for datagram in self.connection.datagrams:
-            if not datagram.payload_len:
-                continue # ignore packets without payload
-            if not first and datagram.sent_by_client:
-                iats.append(\
-                        (datagram.time - last_datagram.time).total_seconds())
-                last_datagram = datagram
-            if first and datagram.sent_by_client:
-                last_datagram = datagram
-                first = False
-
-        compt = 0.
-
-        # for each value, if the value of IAT is close enough to the one of the
-        # RTT, increment the value of compt.
-        for i in range(len(rtts)):
-            if rtts[i] != 0 and abs((rtts[i] - iats[i])/rtts[i]) \
-                                                        <= self.CLOSE_ENOUGH:
-                compt += 1
+        iats = self.connection.features.iats(True)
+
+        # count the values for which the IAT is close enough to the RTT
+        compt = float(count_close(rtts, iats, self.CLOSE_ENOUGH))
 
         self.logger.debug('Similarity between IATs & RTTs: %.2f%%' \
                   % (float(compt) / len(rtts) * 100))
@@ -142,26 +150,49 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
         # returns True if IATs & RTTs are different enough.
         return compt / len(rtts) <= self.IAT_RTT_DIFFERENT
 
-    def closest_group(self, payload, groups):
+    def closest_group(self, payload, keys, groups, order):
         """
-        Returns the closest group for a certain payload.
+        Returns the closest group for a certain payload, or None if no
+        group is close enough.
+
+        keys are the sorted groups. When two groups are close enough, the
+        choice depends on their order in the groups dict (as when the groups
+        were scanned one by one): order caches these choices.
         """
-        closest = None
-        for group in groups:
-            if abs(group - payload) <= self.IN_GROUP and \
-                    (closest is None or abs(group - payload) < closest):
-                closest = group
-        return closest
-
-    def update_average_possible(self, closest, groups):
+        i = bisect_left(keys, payload - self.IN_GROUP)
+        # the groups are more than IN_GROUP apart: two candidates at most
+        candidates = [group for group in keys[i:i + 2]
+                      if group - payload <= self.IN_GROUP]
+        if len(candidates) < 2:
+            return candidates[0] if candidates else None
+        pair = tuple(candidates)
+        if pair not in order:
+            order[pair] = [group for group in groups if group in pair]
+        first, last = order[pair]
+        # the last group is kept if it is closer than the value of the first
+        return last if abs(last - payload) < first else first
+
+    def cluster_payloads(self, payloads):
         """
-        Checks if the value of the group can be updated (no superposition).
+        Greedily gather the payloads in groups of close payloads.
+        Returns a dict {group: number of payloads}.
+
+        A group is identified by its first payload. The average of its
+        payloads can not move it, since it can not be more than IN_GROUP
+        away from the first payload.
         """
-        prov_average = sum(groups[closest]) / len(groups[closest])
-        for group in groups:
-            if abs(group - prov_average) <= self.IN_GROUP:
-                return False
-        return True
+        keys = [] # sorted groups
+        groups = {} # group: number of payloads
+        order = {} # see closest_group
+        for payload in payloads:
+            closest = self.closest_group(payload, keys, groups, order)
+            if closest is None:
+                insort(keys, payload)
+                groups[payload] = 1
+                order.clear() # the dict may have been resized
+            else:
+                groups[closest] += 1
+        return groups
 
     def is_modally_distributed(self):
         """
@@ -170,23 +201,79 @@ class SteppingStoneDetectionServerSide(SingleConnectionAnalyser):
         self.logger.debug('Checking if n-modulus distribution.')
 
         payloads = [datagram.payload_len for datagram in self.datagrams]
-        groups = {}
-        for payload in payloads:
-            closest = self.closest_group(payload, groups)
-            if closest == None:
-                groups[payload] = [payload]
-            else:
-                groups[closest].append(payload)
-                if self.update_average_possible(closest, groups):
-                    groups[sum(groups[closest]) / len(groups[closest])] = \
-                        groups[closest]
-                    del groups[closest]
+        groups = self.cluster_payloads(payloads)
         nb = 0
-        for group in groups:
-            if len(groups[group]) > len(payloads) * self.MIN_SIZE:
-                nb += len(groups[group])
+        for size in groups.itervalues():
+            if size > len(payloads) * self.MIN_SIZE:
+                nb += size
 
         self.logger.debug( 'n-modulus at %.2f%%' % (float(nb) / \
                                                 len(payloads) * 100 ))
 
         return nb > self.N_MOD_DIST * len(payloads)
+
+
+class TestSteppingStoneDetectionServerSide(unittest.TestCase):
+    """Unit tests for SteppingStoneDetectionServerSide"""
+
+    def setUp(self):
+        """Done before every test"""
+        self.ssd = SteppingStoneDetectionServerSide()
+        self.ssd.activate()
+
+    def tearDown(self):
+        """Done after every test"""
+        self.ssd.deactivate()
+
+    def test_cluster_payloads(self):
+        """Close payloads are gathered in the same group"""
+        self.assertEqual(self.ssd.cluster_payloads([48, 50, 51, 100, 52]),
+                         {48: 3, 52: 1, 100: 1})
+        self.assertEqual(self.ssd.cluster_payloads([48, 55, 50, 54]),
+                         {48: 2, 55: 2})
+
+    def test_count_close(self):
+        """Same count with and without numpy"""
+        global numpy
+        rtts = [random.choice((0, 0.1, 0.2, 0.5)) for _ in xrange(500)]
+        iats = [random.uniform(0, 1) for _ in xrange(499)]
+        expected = sum(1 for rtt, iat in zip(rtts, iats)
+                       if rtt and abs(rtt - iat) <= 0.5 * rtt)
+        saved = numpy
+        try:
+            for numpy in (saved, None):
+                self.assertEqual(count_close(rtts, iats, 0.5), expected)
+                self.assertEqual(count_close([], iats, 0.5), 0)
+        finally:
+            numpy = saved
+
+    def test_time_budget(self):
+        """An analyse interrupted by the time budget is not a warning"""
+        start = datetime(2012, 1, 1)
+        datagrams = [Datagram(i % 2 == 0, start + timedelta(seconds=i),
+                              i, 100, 60, i - 1) for i in xrange(100)]
+        connection = Connection(0, datagrams, start, timedelta(seconds=100),
+                '1.2.3.4', '5.6.7.8', 12345, 22, None, None, None, None, True)
+        connection.compute_rtt()
+        def loop():
+            while True:
+                pass
+        self.ssd.is_stepping_stone = loop
+        def analyse():
+            with time_budget(0.05):
+                self.ssd.analyse(connection)
+        self.assertRaises(TimeBudgetExceeded, analyse)
+
+    def test_sampling(self):
+        """An unknown sampling fails at the activation"""
+        self.ssd.SAMPLING = 'random'
+        self.assertRaises(ValueError, self.ssd.activate)
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
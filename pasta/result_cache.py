@@ -0,0 +1,170 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Store the results of the plugins between two runs
+
+A result is identified by the capture file, the connection, the plugin, its
+version and its parameters: changing one of them makes the plugin analyse the
+connection again
+"""
+
+
+import os, logging, shelve, hashlib, unittest, tempfile, shutil
+from datetime import datetime
+
+
+def plugin_parameters(plugin_object):
+    """Parameters of a plugin: the values of its upper case attributes"""
+    names = set()
+    for cls in type(plugin_object).__mro__:
+        names.update(name for name in vars(cls) if name.isupper())
+    return sorted((name, getattr(plugin_object, name)) for name in names)
+
+
+class ResultCache:
+    """Results of the SingleConnectionAnalyser plugins, kept in a file"""
+
+    def __init__(self, file_name, capture_file, colors=False):
+        """
+        Open (or create) the cache file
+
+        The results of the plugins depend on the colors being enabled or not
+        """
+        self.logger = logging.getLogger('Cache')
+        self.store = shelve.open(file_name, protocol=2)
+        stat = os.stat(capture_file)
+        self.capture = (os.path.abspath(capture_file), stat.st_size,
+                        stat.st_mtime)
+        self.colors = colors
+        self.plugins = {} # identifier of each plugin
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, connection, plugin):
+        """Key of the result of a plugin on a connection"""
+        if plugin not in self.plugins:
+            self.plugins[plugin] = (plugin.name, plugin.version,
+                    repr(plugin_parameters(plugin.plugin_object)))
+        return hashlib.sha1(repr((self.capture,
+            connection.client_ip, connection.client_port,
+            connection.server_ip, connection.server_port,
+            connection.start_time, self.plugins[plugin], self.colors)
+            )).hexdigest()
+
+    def __contains__(self, item):
+        """Is the result of a plugin on a connection in the cache?"""
+        connection, plugin = item
+        return self.key(connection, plugin) in self.store
+
+    def get(self, connection, plugin):
+        """
+        Result of a plugin on a connection (a dictionary, or the
+        RuntimeWarning raised by the plugin), None if not in the cache
+        """
+        result = self.store.get(self.key(connection, plugin))
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def set(self, connection, plugin, result):
+        """Store the result of a plugin on a connection"""
+        self.store[self.key(connection, plugin)] = result
+
+    def close(self):
+        """Write the cache file"""
+        self.logger.info('%d results found in the cache, %d computed'
+                         % (self.hits, self.misses))
+        self.store.close()
+
+
+class TestResultCache(unittest.TestCase):
+    """Unit tests for ResultCache"""
+
+    class FakePlugin(object):
+        THRESHOLD = 0.5
+        def __init__(self):
+            self.name = 'Fake'
+            self.version = '1'
+            self.plugin_object = self
+
+    class FakeConnection(object):
+        def __init__(self, client_port):
+            self.client_ip = '1.2.3.4'
+            self.client_port = client_port
+            self.server_ip = '5.6.7.8'
+            self.server_port = 22
+            self.start_time = datetime(2012, 5, 1)
+
+    def setUp(self):
+        """Done before every test"""
+        self.directory = tempfile.mkdtemp()
+        self.capture = os.path.join(self.directory, 'capture.pcap')
+        with open(self.capture, 'w') as capture_file:
+            capture_file.write('pasta')
+        self.file_name = os.path.join(self.directory, 'cache')
+
+    def tearDown(self):
+        """Done after every test"""
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        """Results are found again in a new run"""
+        plugin = TestResultCache.FakePlugin()
+        connection = TestResultCache.FakeConnection(12345)
+        cache = ResultCache(self.file_name, self.capture)
+        self.assertIsNone(cache.get(connection, plugin))
+        cache.set(connection, plugin, {'Idle': '42%'})
+        cache.close()
+        cache = ResultCache(self.file_name, self.capture)
+        self.assertEqual(cache.get(connection, plugin), {'Idle': '42%'})
+        self.assertNotIn((TestResultCache.FakeConnection(12346), plugin),
+                         cache)
+        cache.close()
+        cache = ResultCache(self.file_name, self.capture, colors=True)
+        self.assertNotIn((connection, plugin), cache)
+        cache.close()
+
+    def test_invalidation(self):
+        """Results are not reused when the plugin changes"""
+        plugin = TestResultCache.FakePlugin()
+        connection = TestResultCache.FakeConnection(12345)
+        cache = ResultCache(self.file_name, self.capture)
+        cache.set(connection, plugin, RuntimeWarning('No result'))
+        self.assertIn((connection, plugin), cache)
+        plugin = TestResultCache.FakePlugin()
+        plugin.THRESHOLD = 0.6
+        self.assertNotIn((connection, plugin), cache)
+        plugin = TestResultCache.FakePlugin()
+        plugin.version = '2'
+        self.assertNotIn((connection, plugin), cache)
+        cache.close()
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
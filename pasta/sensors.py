@@ -0,0 +1,206 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Merge the connections captured at several sensors
+
+The clocks of the sensors are not synchronised: the offset of each sensor is
+estimated from the connections seen by several sensors, and the connections
+are moved in time before being merged
+"""
+
+
+import logging, heapq, unittest
+from bisect import bisect_left
+from datetime import datetime, timedelta
+from connection import Connection
+
+# Maximum offset between the clocks of two sensors
+MAX_OFFSET = timedelta(hours=1)
+# Connections of two sensors are the same if their start times (once the
+# clocks are corrected) differ less than this
+TOLERANCE = timedelta(minutes=1)
+
+
+class Sensor:
+    """The connections of a capture (sorted by start time)"""
+
+    def __init__(self, name, connections):
+        self.name = name
+        self.connections = sorted(connections, key=lambda c: c.start_time)
+        self.offset = None # correction of the clock, None if unknown
+        for connection in self.connections:
+            connection.sensor = name
+
+
+def connection_key(connection):
+    """Addresses and ports of a connection"""
+    return (connection.client_ip, connection.client_port,
+            connection.server_ip, connection.server_port)
+
+def time_index(connections):
+    """Sorted start times of the connections, by addresses and ports"""
+    index = {}
+    for connection in connections:
+        index.setdefault(connection_key(connection), []).append(
+                connection.start_time)
+    for starts in index.itervalues():
+        starts.sort()
+    return index
+
+def closest(starts, time):
+    """Start time of starts (sorted) closest to time"""
+    i = bisect_left(starts, time)
+    return min(starts[max(i - 1, 0):i + 1], key=lambda start: abs(start - time))
+
+def median(values):
+    """Median of a non empty list of timedeltas"""
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+def estimate_offset(reference, sensor, max_offset=MAX_OFFSET):
+    """
+    Offset to add to the clock of sensor to get the clock of reference: the
+    median of the differences of the start times of the connections seen by
+    both, None if they have no connection in common
+    """
+    index = time_index(reference.connections)
+    differences = []
+    for connection in sensor.connections:
+        starts = index.get(connection_key(connection))
+        if starts:
+            difference = closest(starts, connection.start_time) \
+                    - connection.start_time
+            if abs(difference) <= max_offset:
+                differences.append(difference)
+    return median(differences) if differences else None
+
+def align(sensors, max_offset=MAX_OFFSET):
+    """
+    Estimate the offsets of the sensors, relatively to the first one; the
+    offsets of sensors sharing no connection with the others are 0
+    """
+    logger = logging.getLogger('Sensors')
+    sensors[0].offset = timedelta(0)
+    aligned = [sensors[0]]
+    remaining = sensors[1:]
+    while remaining:
+        for sensor in remaining:
+            for reference in aligned:
+                offset = estimate_offset(reference, sensor, max_offset)
+                if offset is not None:
+                    sensor.offset = reference.offset + offset
+                    break
+            if sensor.offset is not None:
+                break
+        else:
+            for sensor in remaining:
+                logger.warning('No connection shared by sensor %s: its'
+                               ' clock is not corrected' % sensor.name)
+                sensor.offset = timedelta(0)
+            break
+        logger.info('Clock offset of sensor %s: %s'
+                    % (sensor.name, sensor.offset))
+        aligned.append(sensor)
+        remaining.remove(sensor)
+
+def merge(sensors, tolerance=TOLERANCE, max_offset=MAX_OFFSET):
+    """
+    Align the sensors and merge their connections (sorted by start time,
+    numbered from 1); a connection seen by several sensors is kept once, as
+    seen by the first of them
+    """
+    align(sensors, max_offset)
+    for sensor in sensors:
+        if sensor.offset:
+            for connection in sensor.connections:
+                connection.shift_time(sensor.offset)
+    # connections seen by a previous sensor are duplicates
+    kept = []
+    index = {}
+    for sensor in sensors:
+        connections = []
+        for connection in sensor.connections:
+            starts = index.get(connection_key(connection))
+            if not starts or abs(closest(starts, connection.start_time)
+                                 - connection.start_time) > tolerance:
+                connections.append(connection)
+        kept.append(connections)
+        for key, starts in time_index(connections).iteritems():
+            index[key] = sorted(index.get(key, []) + starts)
+    # k-way merge of the sorted lists
+    connections = [connection for _, _, _, connection in heapq.merge(*(
+            [(connection.start_time, i, j, connection)
+             for j, connection in enumerate(connections)]
+            for i, connections in enumerate(kept)))]
+    for nb, connection in enumerate(connections, 1):
+        connection.nb = nb
+        connection.logger = logging.getLogger('Conn%d' % nb)
+    return connections
+
+
+class TestSensors(unittest.TestCase):
+    """Unit tests for the merge of sensors"""
+
+    def connection(self, client_ip, server_ip, start):
+        """Connection starting start seconds after noon"""
+        return Connection(0, [], datetime(2012, 5, 1, 12)
+                + timedelta(seconds=start), timedelta(seconds=60), client_ip,
+                server_ip, 40000, 22, None, None, None, None, True)
+
+    def test_merge(self):
+        """Clocks are corrected and duplicates removed"""
+        first = Sensor('first', [self.connection('10.0.0.1', '10.0.0.2', 0),
+                                 self.connection('10.0.0.2', '10.0.0.3', 30)])
+        # clock 2 seconds late, sees the second connection
+        second = Sensor('second', [self.connection('10.0.0.2', '10.0.0.3', 28),
+                                   self.connection('10.0.0.4', '10.0.0.5', 8),
+                                   self.connection('10.0.0.6', '10.0.0.7', 25)])
+        # shares a connection with the second sensor only
+        third = Sensor('third', [self.connection('10.0.0.6', '10.0.0.7', 15)])
+        connections = merge([first, second, third])
+        self.assertEqual((second.offset, third.offset),
+                         (timedelta(seconds=2), timedelta(seconds=12)))
+        self.assertEqual([(c.nb, c.client_ip, c.sensor,
+                           c.start_time.second) for c in connections],
+                         [(1, '10.0.0.1', 'first', 0),
+                          (2, '10.0.0.4', 'second', 10),
+                          (3, '10.0.0.6', 'second', 27),
+                          (4, '10.0.0.2', 'first', 30)])
+
+    def test_median(self):
+        """Median of timedeltas"""
+        self.assertEqual(median([timedelta(seconds=s) for s in (3, 1, 2)]),
+                         timedelta(seconds=2))
+        self.assertEqual(median([timedelta(seconds=s) for s in (4, 1)]),
+                         timedelta(seconds=2.5))
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()
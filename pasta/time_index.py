@@ -0,0 +1,152 @@
+#!/usr/bin/python2.7
+
+# Copyright (C) 2012 The PASTA team.
+# See the README file for the exhaustive list of authors.
+#
+# This file is part of PASTA.
+#
+# PASTA is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PASTA is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PASTA.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Index of the connections by their time of activity, to find the connections
+active at a given time or during a period
+"""
+
+
+import unittest
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+
+class TimeIndex:
+    """
+    Interval tree of the connections (from their start time to their end):
+    a complete binary tree over the connections sorted by start time, each
+    node keeping the latest end of its connections
+
+    The index is static: it is built once (in O(n log n)) and can not be
+    changed. A query visits the ancestors of the connections found and the
+    path to the last connection starting before the end of the period, so it
+    costs O((1 + k) log n) for k connections found
+    """
+
+    def __init__(self, connections):
+        # sorted by start time (stable: ties in the order of connections)
+        self.connections = sorted(connections, key=lambda c: c.start_time)
+        self.starts = [c.start_time for c in self.connections]
+        self.size = 1
+        while self.size < len(self.connections):
+            self.size *= 2
+        # latest end of each node (node 1 is the root, node i has the
+        # children 2i and 2i+1, the leaves are from size)
+        self.ends = [datetime.min] * (2 * self.size)
+        for i, connection in enumerate(self.connections):
+            self.ends[self.size + i] = connection.start_time \
+                    + connection.duration
+        for node in xrange(self.size - 1, 0, -1):
+            self.ends[node] = max(self.ends[2 * node], self.ends[2 * node + 1])
+
+    def active_between(self, start, end):
+        """Connections active during a part of the period, by start time"""
+        if not self.connections or end < start:
+            return []
+        # only the connections starting before the end of the period
+        last = bisect_right(self.starts, end)
+        active = []
+        stack = [(1, 0, self.size)] # node, first and last + 1 leaves
+        while stack:
+            node, first, stop = stack.pop()
+            if first >= last or self.ends[node] < start:
+                continue
+            if node >= self.size:
+                active.append(self.connections[first])
+            else:
+                middle = (first + stop) // 2
+                stack.append((2 * node + 1, middle, stop))
+                stack.append((2 * node, first, middle))
+        return active
+
+    def active_at(self, time):
+        """Connections active at a given time, by start time"""
+        return self.active_between(time, time)
+
+
+class TestTimeIndex(unittest.TestCase):
+    """Unit tests for TimeIndex"""
+
+    class FakeConnection(object):
+        def __init__(self, nb, start, duration):
+            self.nb = nb
+            self.start_time = datetime(2012, 5, 1) + timedelta(seconds=start)
+            self.duration = timedelta(seconds=duration)
+
+    def test_active(self):
+        """Same connections as when scanning all of them"""
+        import random
+        connections = [self.FakeConnection(nb, random.uniform(0, 1000),
+                                           random.expovariate(0.02))
+                       for nb in xrange(300)]
+        index = TimeIndex(connections)
+        for _ in xrange(100):
+            start = datetime(2012, 5, 1) + timedelta(
+                    seconds=random.uniform(-10, 1100))
+            end = start + timedelta(seconds=random.choice((0, 1, 30)))
+            self.assertEqual(index.active_between(start, end), sorted(
+                    (c for c in connections if c.start_time <= end
+                     and c.start_time + c.duration >= start),
+                    key=lambda c: c.start_time))
+
+    def test_long_intervals(self):
+        """Long connections are found among many short ones"""
+        import random
+        connections = [self.FakeConnection(nb, nb, 1) for nb in xrange(500)]
+        # long ones, overlapping each other and the short ones
+        connections += [self.FakeConnection(500 + nb, start, duration)
+                        for nb, (start, duration) in enumerate(((3, 1000),
+                            (7, 400), (250, 10), (260, 300), (0, 499.5)))]
+        random.shuffle(connections)
+        index = TimeIndex(connections)
+        at = lambda second: sorted(c.nb for c in index.active_at(
+                datetime(2012, 5, 1) + timedelta(seconds=second)))
+        self.assertEqual(at(499.7), [499, 500, 503])
+        self.assertEqual(at(1003), [500])
+        self.assertEqual(at(255.5), [255, 500, 501, 502, 504])
+        for second in xrange(-5, 1010, 7):
+            self.assertEqual(at(second), sorted(c.nb for c in connections
+                    if c.start_time <= datetime(2012, 5, 1)
+                        + timedelta(seconds=second)
+                        <= c.start_time + c.duration))
+
+    def test_bounds(self):
+        """The start and the end of a connection are included"""
+        connections = [self.FakeConnection(1, 10, 5),
+                       self.FakeConnection(2, 15, 5)]
+        index = TimeIndex(connections)
+        at = lambda second: [c.nb for c in index.active_at(
+                datetime(2012, 5, 1) + timedelta(seconds=second))]
+        self.assertEqual(at(9), [])
+        self.assertEqual(at(10), [1])
+        self.assertEqual(at(15), [1, 2])
+        self.assertEqual(at(21), [])
+        self.assertEqual(TimeIndex([]).active_at(datetime.now()), [])
+
+
+if __name__ == '__main__':
+    import sys
+    # check Python version
+    if sys.version_info[:2] != (2, 7):
+        sys.stderr.write('PASTA must be run with Python 2.7\n')
+        sys.exit(1)
+    # run the unit tests
+    unittest.main()